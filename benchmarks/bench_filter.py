@@ -0,0 +1,53 @@
+"""Throughput of threaded channel-parallel filtering against channel count.
+
+Filters synthetic white noise channels x samples data with
+:func:`pyautomagic.preprocessing.performFilter.performFilter` (the 0.5 Hz
+high-pass of ``Preprocess``, kernel designed beforehand) for several
+channel counts and ``n_jobs``, and reports the throughput in million
+samples per second together with the speedup over one thread.
+
+Usage (with pyautomagic installed, e.g. ``pip install -e .``)::
+
+    python benchmarks/bench_filter.py [n_samples] [n_jobs ...]
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+from pyautomagic.preprocessing.performFilter import performFilter
+
+SFREQ = 500
+CHANNEL_COUNTS = (8, 32, 64, 128, 256)
+
+
+def main(n_samples=150000, n_jobs_list=(1, 2, 4, 8, os.cpu_count())):
+    n_jobs_list = sorted(set(n_jobs_list))
+    print(f"{'channels':>9} {'n_jobs':>7} {'Msamples/s':>11} {'speedup':>8}")
+    rng = np.random.RandomState(0)
+    # design the kernel outside of the timings
+    performFilter(rng.randn(1, n_samples), SFREQ, "high", 0.5)
+    for n_channels in CHANNEL_COUNTS:
+        EEG = rng.randn(n_channels, n_samples)
+        for n_jobs in n_jobs_list:
+            elapsed = min(
+                timeit.repeat(
+                    lambda: performFilter(EEG, SFREQ, "high", 0.5, n_jobs=n_jobs),
+                    number=1,
+                    repeat=3,
+                )
+            )
+            if n_jobs == n_jobs_list[0]:
+                t_single = elapsed
+            print(
+                f"{n_channels:>9} {n_jobs:>7} {EEG.size / elapsed / 1e6:>11.1f} "
+                f"{t_single / elapsed:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]), [int(n) for n in sys.argv[2:]] or (1, 2, 4, 8))
+    else:
+        main()
@@ -0,0 +1,53 @@
+"""Wall time of the IIR (second order sections) against the FIR filters.
+
+Filters synthetic white noise channels x samples recordings of several
+hours with the 0.5 Hz high-pass of ``Preprocess`` through
+:func:`pyautomagic.preprocessing.performFilter.performFilter` with
+``method='fir'`` and ``method='iir'`` (filters designed beforehand), and
+reports both times, the speedup and the relative RMS difference of the
+outputs away from the edges.
+
+Usage (with pyautomagic installed, e.g. ``pip install -e .``)::
+
+    python benchmarks/bench_filter_iir.py [n_channels] [hours ...]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from pyautomagic.preprocessing.performFilter import performFilter
+
+SFREQ = 500
+
+
+def main(n_channels=8, hours=(0.5, 1, 2)):
+    print(f"{'hours':>6} {'fir s':>8} {'iir s':>8} {'speedup':>8} {'rms diff':>9}")
+    rng = np.random.RandomState(0)
+    for method in ("fir", "iir"):
+        performFilter(rng.randn(1, 10 * SFREQ), SFREQ, "high", 0.5, method=method)
+    for duration in hours:
+        EEG = rng.randn(n_channels, int(duration * 3600 * SFREQ))
+        out = {}
+        elapsed = {}
+        for method in ("fir", "iir"):
+            elapsed[method] = timeit.timeit(
+                lambda: out.update(
+                    {method: performFilter(EEG, SFREQ, "high", 0.5, method=method)}
+                ),
+                number=1,
+            )
+        edge = 60 * SFREQ
+        diff = (out["fir"] - out["iir"])[:, edge:-edge]
+        rms = np.sqrt(np.mean(diff ** 2) / np.mean(out["fir"][:, edge:-edge] ** 2))
+        print(
+            f"{duration:>6} {elapsed['fir']:>8.2f} {elapsed['iir']:>8.2f} "
+            f"{elapsed['fir'] / elapsed['iir']:>7.1f}x {rms:>9.4f}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]), [float(h) for h in sys.argv[2:]] or (0.5, 1, 2))
+    else:
+        main()
@@ -0,0 +1,62 @@
+"""Accuracy and wall time of the multirate against the FIR high-pass.
+
+High-pass filters synthetic channels x samples recordings (a random walk
+drift plus white noise) with
+:func:`pyautomagic.preprocessing.performFilter.performFilter` with
+``method='fir'`` and ``method='multirate'`` (filters designed beforehand),
+for several sampling rates and low cutoffs, and reports both times, the
+speedup and the relative RMS difference of the outputs.
+
+Usage (with pyautomagic installed, e.g. ``pip install -e .``)::
+
+    python benchmarks/bench_filter_multirate.py [n_channels] [seconds]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from pyautomagic.preprocessing.performFilter import performFilter
+
+CASES = [(1000, 0.1), (1000, 0.5), (2000, 0.1), (5000, 0.1), (5000, 0.5)]
+
+
+def make_data(n_channels, n_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    drift = 0.05 * np.cumsum(rng.randn(n_channels, n_samples), axis=-1)
+    return drift + rng.randn(n_channels, n_samples)
+
+
+def main(n_channels=8, seconds=300):
+    print(
+        f"{'sfreq':>6} {'cutoff':>7} {'fir s':>7} {'multirate s':>12} "
+        f"{'speedup':>8} {'rms diff':>9}"
+    )
+    for sfreq, filt_freq in CASES:
+        EEG = make_data(n_channels, int(seconds * sfreq))
+        out = {}
+        elapsed = {}
+        for method in ("fir", "multirate"):
+            # design the kernels outside of the timings
+            performFilter(EEG[:1], sfreq, "high", filt_freq, method=method)
+            elapsed[method] = timeit.timeit(
+                lambda: out.update(
+                    {
+                        method: performFilter(
+                            EEG, sfreq, "high", filt_freq, method=method
+                        )
+                    }
+                ),
+                number=1,
+            )
+        diff = out["multirate"] - out["fir"]
+        rms = np.sqrt(np.mean(diff ** 2) / np.mean(out["fir"] ** 2))
+        print(
+            f"{sfreq:>6} {filt_freq:>7} {elapsed['fir']:>7.2f} "
+            f"{elapsed['multirate']:>12.2f} "
+            f"{elapsed['fir'] / elapsed['multirate']:>7.1f}x {rms:>9.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main(*[float(arg) if "." in arg else int(arg) for arg in sys.argv[1:]])
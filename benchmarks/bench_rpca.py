@@ -0,0 +1,55 @@
+"""Per-iteration wall time of the RPCA solver paths.
+
+Runs a fixed number of ALM iterations of
+:func:`pyautomagic.preprocessing.rpca.rpca` on synthetic channels x samples
+data (a low rank signal plus sparse spikes) and reports the mean time per
+iteration for each ``svd_method``. Note that the randomized path predicts
+its rank from the previous iteration, so its first iterations are not
+representative of a long solve.
+
+Usage (with pyautomagic installed, e.g. ``pip install -e .``)::
+
+    python benchmarks/bench_rpca.py [n_channels] [n_samples ...]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from pyautomagic.preprocessing.rpca import rpca
+
+N_ITER = 10
+
+
+def make_data(n_channels, n_samples, rank=10, seed=0):
+    rng = np.random.RandomState(seed)
+    low_rank = np.dot(rng.randn(n_channels, rank), rng.randn(rank, n_samples))
+    spikes = rng.randn(n_channels, n_samples) * (rng.rand(n_channels, n_samples) < 0.01)
+    return low_rank + 20 * spikes
+
+
+def time_per_iteration(M, **kwargs):
+    # tol=0 forces exactly N_ITER iterations
+    elapsed = timeit.timeit(lambda: rpca(M, tol=0, maxIter=N_ITER, **kwargs), number=1)
+    return elapsed / N_ITER
+
+
+def main(n_channels=128, sample_counts=(10000, 50000, 200000)):
+    print(f"{'samples':>10} {'method':>8} {'s/iter':>10} {'speedup':>8}")
+    for n_samples in sample_counts:
+        M = make_data(n_channels, n_samples)
+        base = None
+        for svd_method in ("svd", "gram", "randomized"):
+            t = time_per_iteration(M, svd_method=svd_method)
+            base = base or t
+            print(f"{n_samples:>10} {svd_method:>8} {t:>10.4f} {base / t:>7.1f}x")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    if len(args) > 1:
+        main(args[0], args[1:])
+    elif args:
+        main(args[0])
+    else:
+        main()
@@ -0,0 +1,44 @@
+"""Wall time of batched RPCA against one rpca call per matrix.
+
+Solves a stack of synthetic channels x samples matrices (see
+``bench_rpca.make_data``) with :func:`pyautomagic.preprocessing.rpca.rpca_batch`
+and with a loop over :func:`pyautomagic.preprocessing.rpca.rpca`, for
+several stack shapes. Batching removes the per-call overhead, which
+dominates small matrices; on large ones the in-place updates of the whole
+stack no longer fit in cache and the loop is faster.
+
+Usage (with pyautomagic installed, e.g. ``pip install -e .``)::
+
+    python benchmarks/bench_rpca_batch.py
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+from bench_rpca import make_data  # noqa: E402
+
+from pyautomagic.preprocessing.rpca import rpca, rpca_batch  # noqa: E402
+
+SHAPES = [(200, 8, 128), (100, 32, 256), (50, 64, 1000), (20, 64, 5000)]
+
+
+def main(shapes=SHAPES):
+    print(f"{'batch':>6} {'shape':>10} {'loop s':>8} {'batch s':>8} {'speedup':>8}")
+    for n_batch, n_channels, n_samples in shapes:
+        M = np.array(
+            [make_data(n_channels, n_samples, rank=2, seed=k) for k in range(n_batch)]
+        )
+        t_loop = timeit.timeit(lambda: [rpca(m) for m in M], number=1)
+        t_batch = timeit.timeit(lambda: rpca_batch(M), number=1)
+        shape = f"{n_channels}x{n_samples}"
+        print(
+            f"{n_batch:>6} {shape:>10} {t_loop:>8.3f} {t_batch:>8.3f} "
+            f"{t_loop / t_batch:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Approximation error and wall time of column sampled (coreset) RPCA.
+
+Solves each benchmark recording with the exact
+:func:`pyautomagic.preprocessing.rpca.rpca` and with its ``coreset`` mode,
+for both column samplings and several sample sizes, and reports the
+relative Frobenius error of L and S against the exact solve together with
+the speedup. The exact solver stopped early at the tolerance the
+coreset mode extends to (``CORESET_TOL``) is reported as a baseline. The
+recordings are a synthetic channels x samples matrix
+(see ``bench_rpca.make_data``) and the EDF files of ``tests/test_data``,
+high-pass filtered at 1 Hz as in ``Preprocess``.
+
+Usage (with pyautomagic installed, e.g. ``pip install -e .``)::
+
+    python benchmarks/bench_rpca_coreset.py
+"""
+import glob
+import os
+import sys
+import timeit
+
+import mne
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+from bench_rpca import make_data  # noqa: E402
+
+from pyautomagic.preprocessing.rpca import CORESET_TOL, rpca  # noqa: E402
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "tests", "test_data")
+CORESETS = (0.05, 0.1, 0.25)
+
+
+def load_datasets():
+    datasets = {"synthetic 64x20000": make_data(64, 20000)}
+    for fname in sorted(glob.glob(os.path.join(TEST_DATA, "*.edf"))):
+        raw = mne.io.read_raw_edf(fname, preload=True, verbose=False)
+        raw.filter(1, None, verbose=False)
+        datasets[os.path.basename(fname)] = raw.get_data()
+    return datasets
+
+
+def relative_error(X, X_exact):
+    return np.linalg.norm(X - X_exact) / np.linalg.norm(X_exact)
+
+
+def main(coresets=CORESETS):
+    print(
+        f"{'data':>20} {'sampling':>9} {'coreset':>8} "
+        f"{'L error':>8} {'S error':>8} {'speedup':>8}"
+    )
+    for name, M in load_datasets().items():
+        exact = []
+        t_exact = timeit.timeit(lambda: exact.extend(rpca(M)), number=1)
+        early = []
+        t = timeit.timeit(lambda: early.extend(rpca(M, tol=CORESET_TOL)), number=1)
+        print(
+            f"{name:>20} {'exact':>9} {'-':>8} "
+            f"{relative_error(early[0], exact[0]):>8.4f} "
+            f"{relative_error(early[1], exact[1]):>8.4f} "
+            f"{t_exact / t:>7.1f}x"
+        )
+        for sampling in ("uniform", "leverage"):
+            for coreset in coresets:
+                approx = []
+                t = timeit.timeit(
+                    lambda: approx.extend(
+                        rpca(M, coreset=coreset, coreset_sampling=sampling)
+                    ),
+                    number=1,
+                )
+                print(
+                    f"{name:>20} {sampling:>9} {coreset:>8} "
+                    f"{relative_error(approx[0], exact[0]):>8.4f} "
+                    f"{relative_error(approx[1], exact[1]):>8.4f} "
+                    f"{t_exact / t:>7.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
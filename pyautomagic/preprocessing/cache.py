@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+METADATA = "metadata.json"
+
+
+class StageCache:
+    """
+    Content-addressed on-disk cache of the outputs of the stages of
+    Preprocess.
+
+    An output is a dict of arrays, saved as .npy files and loaded back memory
+    mapped (copy-on-write, so a stage transforming it in place never changes
+    the cache), and a dict of JSON metadata, saved together in the folder
+    cache_dir/<key>. Keys are hashes of the key of the input of a stage and
+    of its parameters (see key), so the output of a stage is found again
+    whenever its input and parameters are the same, and a changed parameter
+    only misses the stages depending on it.
+
+    Outputs are written to a temporary folder renamed in place, so that
+    concurrent workers never read a partial output. When the cache grows
+    beyond max_size bytes, the least recently used outputs are evicted.
+
+    Parameters
+    ----------
+    cache_dir : str
+        folder of the cache, created if needed
+    max_size : int | None
+        largest size of the cache in bytes, unbounded if None
+
+    Attributes
+    ----------
+    cache_dir : str
+        folder of the cache
+    max_size : int | None
+        largest size of the cache in bytes
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """
+        Hashes parts, JSON serializable values and arrays (hashed by their
+        dtype, shape and content), into a key.
+
+        Parameters
+        ----------
+        *parts
+            e.g. the key of the input of a stage, its name and its parameters
+
+        Returns
+        -------
+        key : str
+            hexadecimal sha1 of parts
+        """
+        return hashlib.sha1(
+            json.dumps(parts, sort_keys=True, default=_hashable).encode()
+        ).hexdigest()
+
+    def get(self, key):
+        """
+        Loads the output stored under key, if any, and marks it as used.
+
+        Parameters
+        ----------
+        key : str
+            key of the output
+
+        Returns
+        -------
+        arrays : dict | None
+            arrays of the output, memory mapped copy-on-write, None if the
+            output is not in the cache
+        metadata : dict | None
+            metadata of the output, None if the output is not in the cache
+        """
+        folder = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(folder, METADATA)) as fid:
+                metadata = json.load(fid)
+            arrays = {
+                name: np.load(os.path.join(folder, name + ".npy"), mmap_mode="c")
+                for name in metadata["arrays"]
+            }
+        except (OSError, ValueError):
+            # missing, or evicted by another worker while loading
+            return None, None
+        # the modification time of the metadata orders evictions
+        os.utime(os.path.join(folder, METADATA))
+        return arrays, metadata["metadata"]
+
+    def put(self, key, arrays, metadata):
+        """
+        Stores an output under key, then evicts the least recently used
+        outputs while the cache is larger than max_size.
+
+        Parameters
+        ----------
+        key : str
+            key of the output
+        arrays : dict
+            arrays of the output, by name
+        metadata : dict
+            JSON serializable metadata of the output
+        """
+        folder = os.path.join(self.cache_dir, key)
+        if os.path.exists(folder):
+            return
+        tmp = "%s.%d.tmp" % (folder, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), np.asarray(array))
+        with open(os.path.join(tmp, METADATA), "w") as fid:
+            json.dump(
+                {"arrays": list(arrays), "metadata": metadata},
+                fid,
+                default=_serializable,
+            )
+        try:
+            os.replace(tmp, folder)
+        except OSError:
+            # stored by another worker in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def size(self):
+        """
+        Returns
+        -------
+        size : int
+            size of the outputs in the cache, in bytes
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Removes the least recently used outputs until the cache is at most
+        max_size bytes.
+        """
+        if self.max_size is None:
+            return
+        entries = sorted(self._entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, folder in entries:
+            if size <= self.max_size:
+                break
+            shutil.rmtree(folder, ignore_errors=True)
+            size -= entry_size
+
+    def clear(self):
+        """
+        Removes every output of the cache.
+        """
+        for _, _, folder in self._entries():
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def _entries(self):
+        # (last use, size, folder) of every stored output
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            metadata = os.path.join(entry.path, METADATA)
+            if entry.name.endswith(".tmp") or not os.path.exists(metadata):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((os.path.getmtime(metadata), size, entry.path))
+            except OSError:
+                continue
+        return entries
+
+
+def _hashable(value):
+    # arrays (and e.g. memory maps) are keyed by their content
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha1(np.ascontiguousarray(value)).hexdigest()
+        return [str(value.dtype), list(value.shape), digest]
+    return _serializable(value)
+
+
+def _serializable(value):
+    # numpy scalars and arrays in metadata, other objects by their repr
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return repr(value)
@@ -1,21 +1,35 @@
 import numpy as np
 
+# samples of EEG and EOG read at a time, which bounds the memory of the
+# regression independently of the length of the recording
+CHUNK_SIZE = 10000
 
-def perform_EOG_regression(EEG, EOG):
+
+def perform_EOG_regression(EEG, EOG, chunk_size=CHUNK_SIZE, out=None):
     """The artifacts due to EOG activity are removed from the EEG data using the subtraction method
         that relies on the linear transformation of the EEG signal
 
+        The regression coefficients are fitted in a first pass over chunks of
+        the recording (see EOG_regression_coefficients), and subtracted in a
+        second one (see apply_EOG_regression), so EEG, EOG and out can be
+        memory-mapped arrays of any length.
+
         Parameters
         ----------
         EEG: np.ndarray
-             The input EEG data
+             The input EEG data, shape (n_eeg, n_times) or (n_times,)
         EOG: np.ndarray
-             The input EOG data
+             The input EOG data, shape (n_eog, n_times) or (n_times,)
+        chunk_size: int
+             Number of samples processed at a time
+        out: np.ndarray | None
+             Array of shape (n_eeg, n_times) to write the cleaned EEG to, e.g.
+             a np.memmap, allocated in the (floating point) dtype of EEG if None
 
         Returns
         -------
         clean_EEG: np.ndarray
-                   Cleaned EEG signal from EOG artifacts
+                   Cleaned EEG signal from EOG artifacts, shape (n_eeg, n_times)
 
         References
         __________
@@ -23,22 +37,92 @@ def perform_EOG_regression(EEG, EOG):
         Neuroimage, 200, 460-473. doi: 10.1016/j.neuroimage.2019.06.046
         """
 
-    size_EEG = np.shape(EEG)
-    size_EOG = np.shape(EOG)
-    dimension1 = len(size_EOG)
-    dimension2 = len(size_EEG)
-    # resizing the EOG array so that its pseudoinverse can be calculated
-    if dimension1 == 1:
-        EOG.resize((1, size_EOG[0]))
-    if dimension2 == 1:
-        EEG.resize((1, size_EEG[0]))
-
-    EEG_t = np.transpose(EEG)
-    EOG_t = np.transpose(EOG)
-    # performing pseudoinverse
-    pseudoinv = np.linalg.pinv(np.dot(np.transpose(EOG_t), EOG_t))
-    inv = np.dot(pseudoinv, np.transpose(EOG_t))
-    subtract_EOG = np.dot(EOG_t, np.dot(inv, EEG_t))
-    # subtracting the EOG noise from the EEG signal
-    clean_EEG = np.transpose(np.subtract(EEG_t, subtract_EOG))
-    return clean_EEG
+    coef = EOG_regression_coefficients(EEG, EOG, chunk_size)
+    return apply_EOG_regression(EEG, EOG, coef, chunk_size, out)
+
+
+def EOG_regression_coefficients(EEG, EOG, chunk_size=CHUNK_SIZE):
+    """Least squares coefficients of the EOG channels in every EEG channel,
+        i.e. coef minimizing ||EEG - coef^T EOG||, in one pass over chunks of
+        the recording
+
+        The QR factorization EOG^T = Q R is updated chunk by chunk (the R of
+        the previous chunks stacked on top of the next EOG samples is
+        factorized again), together with Q^T EEG^T, and coef solves R coef =
+        Q^T EEG^T. Unlike the normal equations (EOG EOG^T) coef = EOG EEG^T,
+        this does not square the condition number of EOG. Rank deficient EOG
+        gets the minimum norm solution, as with the pseudoinverse.
+
+        Parameters
+        ----------
+        EEG: np.ndarray
+             The input EEG data, shape (n_eeg, n_times) or (n_times,)
+        EOG: np.ndarray
+             The input EOG data, shape (n_eog, n_times) or (n_times,)
+        chunk_size: int
+             Number of samples processed at a time
+
+        Returns
+        -------
+        coef: np.ndarray
+              float64 regression coefficients, shape (n_eog, n_eeg)
+        """
+
+    EEG = np.atleast_2d(EEG)
+    EOG = np.atleast_2d(EOG)
+    n_eog = EOG.shape[0]
+    n_times = EEG.shape[1]
+    if EOG.shape[1] != n_times:
+        raise ValueError("EEG and EOG must have the same number of samples")
+    # R and Q^T EEG^T of the samples so far, accumulated in double precision
+    R = np.zeros((0, n_eog))
+    QtEEG = np.zeros((0, EEG.shape[0]))
+    for start in range(0, n_times, chunk_size):
+        stop = min(start + chunk_size, n_times)
+        Q, R = np.linalg.qr(
+            np.concatenate([R, EOG[:, start:stop].T.astype(np.float64)])
+        )
+        QtEEG = np.dot(
+            Q.T, np.concatenate([QtEEG, EEG[:, start:stop].T.astype(np.float64)])
+        )
+    return np.linalg.lstsq(R, QtEEG, rcond=None)[0]
+
+
+def apply_EOG_regression(EEG, EOG, coef, chunk_size=CHUNK_SIZE, out=None):
+    """Subtracts the EOG channels weighted by coef from the EEG, chunk by
+        chunk
+
+        Parameters
+        ----------
+        EEG: np.ndarray
+             The input EEG data, shape (n_eeg, n_times) or (n_times,)
+        EOG: np.ndarray
+             The input EOG data, shape (n_eog, n_times) or (n_times,)
+        coef: np.ndarray
+              Regression coefficients, shape (n_eog, n_eeg), e.g. from
+              EOG_regression_coefficients
+        chunk_size: int
+             Number of samples processed at a time
+        out: np.ndarray | None
+             Array of shape (n_eeg, n_times) to write the cleaned EEG to, e.g.
+             a np.memmap, allocated in the (floating point) dtype of EEG if None
+
+        Returns
+        -------
+        clean_EEG: np.ndarray
+                   Cleaned EEG signal from EOG artifacts, shape (n_eeg, n_times)
+        """
+
+    EEG = np.atleast_2d(EEG)
+    EOG = np.atleast_2d(EOG)
+    if out is None:
+        out = np.empty(EEG.shape, np.result_type(EEG.dtype, np.float32))
+    weights = np.asarray(coef).T.astype(out.dtype)
+    for start in range(0, EEG.shape[1], chunk_size):
+        stop = min(start + chunk_size, EEG.shape[1])
+        np.subtract(
+            EEG[:, start:stop],
+            np.dot(weights, EOG[:, start:stop].astype(out.dtype)),
+            out=out[:, start:stop],
+        )
+    return out
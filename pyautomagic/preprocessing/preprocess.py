@@ -1,11 +1,210 @@
+import contextlib
+import json
+import os
+import tracemalloc
+
 import matplotlib.pyplot as plt
 import mne
 import numpy as np
+from scipy import sparse
 from pyprep.prep_pipeline import PrepPipeline
 
-from pyautomagic.preprocessing.performFilter import performFilter
-from pyautomagic.preprocessing.perform_EOG_regression import perform_EOG_regression
-from pyautomagic.preprocessing.rpca import rpca
+from pyautomagic.preprocessing.cache import StageCache
+from pyautomagic.preprocessing.performFilter import (
+    interpolate_line_noise,
+    performFilter,
+)
+from pyautomagic.preprocessing.perform_EOG_regression import (
+    EOG_regression_coefficients,
+    apply_EOG_regression,
+)
+from pyautomagic.preprocessing.rpca import (
+    RPCADiagnostics,
+    get_solver,
+    rpca_batch,
+    rpca_windowed,
+)
+
+
+class Stage:
+    """ Stage
+    Node of the DAG of the stages of Preprocess.fit.
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+    params : list of str
+        keys of the parameters of Preprocess the output of the stage depends on
+    inputs : list of str
+        stages whose outputs the stage transforms
+    resampled_inputs : list of str | None
+        inputs of the stage if params['resample_sfreq'] is set, if they differ
+    """
+
+    def __init__(self, name, params, inputs, resampled_inputs=None):
+        self.name = name
+        self.params = params
+        self.inputs = inputs
+        self.resampled_inputs = resampled_inputs
+
+    def get_inputs(self, params):
+        """ get_inputs
+        Returns
+        -------
+        inputs : list of str
+            stages whose outputs the stage transforms with params
+        """
+        if (
+            self.resampled_inputs is not None
+            and params.get("resample_sfreq") is not None
+        ):
+            return self.resampled_inputs
+        return self.inputs
+
+
+# the stages of Preprocess.fit, in the order they are performed when they do
+# not depend on each other. Resampling is fused with filtering, which then
+# comes before prep so that every stage runs at the new rate
+STAGES = {
+    stage.name: stage
+    for stage in [
+        Stage("load", [], []),
+        Stage("prep", ["interpolation_params"], ["load"], ["filtering"]),
+        Stage(
+            "filtering",
+            [
+                "filter_type",
+                "filt_freq",
+                "filter_length",
+                "filter_method",
+                "line_noise_method",
+                "line_freqs",
+                "resample_sfreq",
+                "dtype",
+            ],
+            ["load"],
+        ),
+        Stage(
+            "perform_eog_regression",
+            ["eog_regression", "eog_coef_reuse"],
+            ["filtering"],
+        ),
+        Stage(
+            "perform_RPCA",
+            [
+                "lam",
+                "tol",
+                "max_iter",
+                "rpca_svd_method",
+                "rpca_window",
+                "rpca_overlap",
+                "rpca_stall_window",
+                "sparse_noise",
+                "rpca_coreset",
+                "rpca_coreset_sampling",
+                "rpca_solver",
+                "rpca_solver_params",
+            ],
+            ["perform_eog_regression"],
+        ),
+    ]
+}
+
+
+def stage_order(params):
+    """ stage_order
+    Returns
+    -------
+    order : list of str
+        names of the stages, every one after its inputs with params
+    """
+    order = []
+
+    def visit(name):
+        if name not in order:
+            for input_name in STAGES[name].get_inputs(params):
+                visit(input_name)
+            order.append(name)
+
+    for name in STAGES:
+        visit(name)
+    return order
+
+
+def source_files(raw):
+    """ source_files
+    Returns
+    -------
+    files : list
+        name, size and modification time (in ns) of the files raw is read
+        from, which change when the recording is replaced
+    """
+    files = [str(fname) for fname in raw.filenames if fname is not None]
+    return [
+        [os.path.basename(fname), os.path.getsize(fname), os.stat(fname).st_mtime_ns]
+        for fname in files
+    ]
+
+
+def stage_params(params, source=None):
+    """ stage_params
+    Parameters
+    ----------
+    params : dict
+        parameters of Preprocess
+    source : list | None
+        source_files of the recording, the parameter of the load stage
+
+    Returns
+    -------
+    stage_params : dict
+        the parameters in params and the inputs of every stage, by stage, as
+        saved in JSON, to be compared by invalidated_stages with the ones of
+        a later run
+    """
+    current = {
+        name: {
+            "params": {key: params.get(key) for key in stage.params},
+            "inputs": stage.get_inputs(params),
+        }
+        for name, stage in STAGES.items()
+    }
+    current["load"]["params"]["source"] = source
+    return json.loads(json.dumps(current, default=str))
+
+
+def invalidated_stages(last_params, params, source=None):
+    """ invalidated_stages
+    Finds the stages whose output changes with params, those whose
+    parameters or inputs changed since they were performed with last_params
+    and those downstream of them.
+
+    Parameters
+    ----------
+    last_params : dict | None
+        stage_params of the parameters the stages were last performed with,
+        None if they were never performed
+    params : dict
+        parameters of Preprocess
+    source : list | None
+        source_files of the recording, whose change invalidates every stage
+
+    Returns
+    -------
+    invalidated : list of str
+        names of the invalidated stages, in the order of stage_order
+    """
+    current = stage_params(params, source)
+    invalidated = []
+    for name in stage_order(params):
+        if (
+            last_params is None
+            or last_params.get(name) != current[name]
+            or any(input_name in invalidated for input_name in current[name]["inputs"])
+        ):
+            invalidated.append(name)
+    return invalidated
 
 
 class Preprocess:
@@ -24,14 +223,61 @@ class Preprocess:
                           'filter_type' : 'high',
                           'filt_freq' : None,
                           'filter_length' : 'auto',
+                          'filter_n_jobs': 1,
+                          'filter_method': 'fir',
+                          'line_noise_method': None,
+                          'resample_sfreq': None,
+                          'dtype': 'float64',
+                          'low_memory': False,
+                          'report_memory': False,
+                          'stage_cache': False,
+                          'stage_cache_size': 2 ** 34,
                           'eog_regression' : False,
+                          'eog_coef_reuse': False,
                           'lam' : -1,
                           'tol' : 1e-7,
                           'max_iter': 1000,
+                          'rpca_svd_method': 'auto',
+                          'rpca_window': None,
+                          'rpca_overlap': 1,
+                          'n_jobs': 1,
+                          'rpca_stall_window': None,
+                          'rpca_checkpoint_interval': 300,
+                          'sparse_noise': False,
+                          'rpca_coreset': None,
+                          'rpca_coreset_sampling': 'uniform',
+                          'rpca_solver': 'alm',
+                          'rpca_solver_params': {},
                           'interpolation_params': {'line_freqs' : 50,
                                                    'ref_chs': eeg.ch_names,
                                                    'reref_chs': eeg.ch_names,
                                                    'montage': 'standard_1020'}
+    checkpoint: str | None
+        path prefix of the RPCA checkpoint files, saved every
+        params['rpca_checkpoint_interval'] seconds so that an interrupted
+        solve is resumed instead of restarted
+    eog_coef_file: str | None
+        path of the EOG regression coefficients shared by the runs of a
+        subject (.npz). They are loaded from it if it was written for the same
+        EEG and EOG channels and filtering parameters (see STAGES), otherwise
+        fitted and, if it does not exist yet or the filtering parameters
+        changed, saved to it for the next runs. Block passes the file of the
+        subject (or session) if params['eog_coef_reuse']
+    stage_cache: StageCache | None
+        cache of the outputs of the stages of fit (loading, prep, filtering,
+        eog regression and RPCA), which are restored from it instead of
+        performed if their input and the parameters they depend on (see
+        STAGES) did not change. Block passes the cache of the project,
+        of at most params['stage_cache_size'] bytes, if params['stage_cache']
+    filter_cache_dir: str | None
+        folder where the FIR filter kernels are cached on disk (see
+        get_kernel). Block passes the folder of the project
+    stored_outputs: dict | None
+        outputs of stages kept from a previous preprocessing of the same
+        recording, as (arrays, metadata) by stage (see _stage_output),
+        restored instead of performing the stages, e.g. the bad channels of
+        prep ({}, {'bads': [...]}) saved in the results of a Block. Block
+        passes the ones of the stages invalidated_stages keeps
 
     Attributes
     ----------
@@ -60,8 +306,30 @@ class Preprocess:
         mne raw object containing eeg data after filtering, eog_regression, and
         robust PCA (final cleaned data)
 
-    noise : numpy.array
-        array of the noise removed from rpca
+    noise : numpy.array | scipy.sparse.csr_matrix
+        array of the noise removed from rpca, stored as a sparse matrix if
+        params['sparse_noise']
+
+    checkpoint : str | None
+        path prefix of the RPCA checkpoint files described above
+
+    eog_coef_file : str | None
+        path of the shared EOG regression coefficients described above
+
+    stage_cache : StageCache | None
+        cache of the outputs of the stages described above
+
+    filter_cache_dir : str | None
+        folder of the cached filter kernels described above
+
+    stored_outputs : dict
+        outputs of stages described above, by stage
+
+    stage_keys : dict
+        key of the output of every stage performed or restored, by stage
+
+    performed : set
+        names of the stages performed or restored (see STAGES)
 
     automagic : dict
         automagic holds information about the progress of the pipeline
@@ -81,6 +349,8 @@ class Preprocess:
         noise.
     def perform_eog_regression
         If requested, it will remove artifact from eog data.
+    prepare_RPCA
+        Performs the steps of fit before RPCA.
     perform_RPCA
         Uses Robust Principal Component Analysis to remove noise from the data.
     plot(self, show=True):
@@ -90,24 +360,46 @@ class Preprocess:
         matlab's automagic package).
     """
 
-    def __init__(self, eeg, params):
-        eeg.load_data()
+    def __init__(
+        self,
+        eeg,
+        params,
+        checkpoint=None,
+        eog_coef_file=None,
+        stage_cache=None,
+        filter_cache_dir=None,
+        stored_outputs=None,
+    ):
+        self.stage_cache = stage_cache
+        self.filter_cache_dir = filter_cache_dir
+        self.stored_outputs = {} if stored_outputs is None else stored_outputs
+        self.stage_keys = {}
+        self.performed = {"load"}
+        if stage_cache is None:
+            eeg.load_data()
+        else:
+            self._load_data(eeg)
         eeg.rename_channels(lambda s: s.strip("."))
         self.eeg = eeg
         self.eog = None
         self.bad_chs = None
         self.params = params
         self.index = 0
-        self.filtered = eeg.copy()
+        # in low memory mode every stage transforms the data of eeg in place
+        self.filtered = eeg if params.get("low_memory", False) else eeg.copy()
         self.eeg_filt_eog = None
         self.eeg_filt_eog_rpca = None
-        self.noise = eeg.copy()
+        self.noise = None
+        self.checkpoint = checkpoint
+        self.eog_coef_file = eog_coef_file
         self.automagic = {
             "prep": {"performed": False},
             "filtering": {"performed": False},
             "perform_eog_regression": False,
-            "perform_RPCA": False,
+            "perform_RPCA": {"performed": False},
         }
+        if stage_cache is not None:
+            self.automagic["stage_cache"] = {}
 
         self.fig1 = None
         self.fig2 = None
@@ -139,7 +431,13 @@ class Preprocess:
     def perform_filter(self):
         """ perform_filter
         Performs initial filter (high, low, or band-pass) and removes line
-        noise.
+        noise, by spectrum interpolation of params['line_freqs'] and its
+        harmonics if params['line_noise_method'] is 'interpolation'. If
+        params['resample_sfreq'] is set, the data is resampled to it by the
+        same pass (the anti-alias filter is fused with the others). The data
+        is converted to params['dtype'] first, and every later step (eog
+        regression, RPCA) keeps it, so that 'float32' halves the memory and
+        bandwidth of the pipeline.
 
         Returns
         -------
@@ -148,18 +446,38 @@ class Preprocess:
         """
 
         self.automagic["filtering"]["performed"] = True
-        self.filtered._data = performFilter(
-            self.filtered.get_data(),
-            self.eeg.info["sfreq"],
+        resample_sfreq = self.params.get("resample_sfreq")
+        data = performFilter(
+            self.filtered._data.astype(self.params.get("dtype", "float64"), copy=False),
+            self.filtered.info["sfreq"],
             self.params["filter_type"],
             self.params["filt_freq"],
             self.params["filter_length"],
+            cache_dir=self.filter_cache_dir,
+            n_jobs=self.params.get("filter_n_jobs", 1),
+            method=self.params.get("filter_method", "fir"),
+            resample_sfreq=resample_sfreq,
         )
+        if resample_sfreq is None:
+            self.filtered._data = data
+        else:
+            self.filtered = _resampled_raw(self.filtered, data, resample_sfreq)
+        if self.params.get("line_noise_method") == "interpolation":
+            # all harmonics of params['line_freqs'] in one FFT round trip
+            self.filtered._data = interpolate_line_noise(
+                self.filtered._data,
+                self.filtered.info["sfreq"],
+                self.params["line_freqs"],
+                n_jobs=self.params.get("filter_n_jobs", 1),
+            )
         return self.filtered
 
     def perform_eog_regression(self):
         """ perform_eog_regression
-        If requested, it will remove artifact from eog data.
+        If requested, it will remove artifact from eog data. The regression
+        coefficients are reused from self.eog_coef_file if given (see
+        Preprocess), and automagic['eog_coefficients'] records whether they
+        were 'fitted' or 'cached'.
 
         Returns
         -------
@@ -167,44 +485,157 @@ class Preprocess:
             Filtered eeg data, with eog regression
         """
 
-        self.eeg_filt_eog = self.filtered.copy()
+        if self.params.get("low_memory", False):
+            self.eeg_filt_eog = self.filtered
+        else:
+            self.eeg_filt_eog = self.filtered.copy()
         if "eog" in self.filtered:
-            eeg = self.filtered.copy()
-            self.eog = self.filtered.copy()
             if self.params["eog_regression"] == True:
                 self.automagic["perform_eog_regression"] = True
             else:
                 self.automagic["perform_eog_regression"] = False
-            eeg_indices = eeg.pick_types(eeg=True)
-            eog_indices = self.eog.pick_types(eog=True)
-            self.eeg_filt_eog._data = perform_EOG_regression(
-                eeg.get_data(eeg_indices), self.eog.get_data(eog_indices)
+            info = self.filtered.info
+            eeg_indices = mne.pick_types(info, eeg=True, exclude=[])
+            eog_indices = mne.pick_types(info, eog=True, exclude=[])
+            data = self.eeg_filt_eog._data
+            EOG = data[eog_indices]
+            self.eog = mne.io.RawArray(
+                EOG, mne.pick_info(info, eog_indices), verbose=False
             )
+            # the coefficients of every channel are fitted independently, so
+            # all of them are fitted and applied in place, those of the
+            # channels other than EEG (e.g. EOG) being set to 0
+            coef = self._eog_coefficients(
+                data,
+                EOG,
+                eeg_indices,
+                [info["ch_names"][i] for i in eeg_indices],
+                self.eog.ch_names,
+            )
+            weights = np.zeros((len(eog_indices), len(data)))
+            weights[:, eeg_indices] = coef
+            apply_EOG_regression(data, EOG, weights, out=data)
         return self.eeg_filt_eog
 
+    def _eog_coefficients(self, data, EOG, eeg_indices, eeg_names, eog_names):
+        # coefficients of the runs of the subject fitted before, if they were
+        # fitted for the same channels on data filtered the same way
+        fname = self.eog_coef_file
+        filtering = StageCache.key(stage_params(self.params)["filtering"])
+        replace = False
+        if fname is not None and os.path.exists(fname):
+            with np.load(fname) as cached:
+                if (
+                    list(cached["eeg_names"]) == eeg_names
+                    and list(cached["eog_names"]) == eog_names
+                ):
+                    if "filtering" in cached and cached["filtering"] == filtering:
+                        self.automagic["eog_coefficients"] = "cached"
+                        return cached["coef"]
+                    # the filtering parameters changed since they were fitted
+                    replace = True
+        coef = EOG_regression_coefficients(data, EOG)[:, eeg_indices]
+        self.automagic["eog_coefficients"] = "fitted"
+        if fname is not None and (replace or not os.path.exists(fname)):
+            os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+            # write then rename, so that concurrent runs never read partial
+            # coefficients
+            tmp = "%s.%d.npz" % (fname[:-4], os.getpid())
+            np.savez(
+                tmp,
+                coef=coef,
+                eeg_names=eeg_names,
+                eog_names=eog_names,
+                filtering=filtering,
+            )
+            os.replace(tmp, fname)
+        return coef
+
     def perform_RPCA(self):
         """ perform_RPCA
         Uses Robust Principal Component Analysis to remove noise from the data.
+        If params['rpca_window'] (in seconds) is set, the data is solved in
+        windows overlapping by params['rpca_overlap'] seconds, across
+        params['n_jobs'] processes. params['rpca_stall_window'] stops solves
+        whose error and rank stop improving (see rpca). Unwindowed solves are
+        checkpointed to self.checkpoint, if given. With params['sparse_noise']
+        the noise, which is mostly exact zeros after soft thresholding, is
+        kept as a scipy.sparse.csr_matrix. params['rpca_coreset'] solves an
+        approximation from a sample of the time columns (see rpca), for quick
+        first passes.
+        params['rpca_solver'] picks the solver by its name in rpca.SOLVERS,
+        'alm' (rpca) or 'altproj' (rpca_altproj), and
+        params['rpca_solver_params'] passes options specific to it (e.g.
+        {'rank': 10} for 'altproj'). Checkpoints and the coreset mode only
+        apply to 'alm'. A summary of every solve (iterations, final error,
+        rank, sparsity, elapsed time and why it stopped) is stored in
+        automagic['perform_RPCA'].
 
         Returns
         -------
         eeg_filt_eog_rpca : numpy.array
             eeg data after filtering, eog_regression, and
             robust PCA (final cleaned data)
-        noise : numpy.array
+        noise : numpy.array | scipy.sparse.csr_matrix
             array of the noise removed from rpca
         """
 
-        self.eeg_filt_eog_rpca = self.eeg_filt_eog.copy()
+        if self.params.get("low_memory", False):
+            self.eeg_filt_eog_rpca = self.eeg_filt_eog
+        else:
+            self.eeg_filt_eog_rpca = self.eeg_filt_eog.copy()
         self.eeg_filt_eog_rpca.load_data()
-        self.automagic["perform_RPCA"] = True
-        self.eeg_filt_eog_rpca._data, self.noise._data = rpca(
-            self.eeg_filt_eog.get_data(),
-            self.params["lam"],
-            self.params["tol"],
-            self.params["max_iter"],
-        )
-        return self.eeg_filt_eog_rpca._data, self.noise._data
+        solver = self.params.get("rpca_solver", "alm")
+        rpca_params = {
+            "lam": self.params["lam"],
+            "tol": self.params["tol"],
+            "maxIter": self.params["max_iter"],
+            "svd_method": self.params.get("rpca_svd_method", "auto"),
+            "stall_window": self.params.get("rpca_stall_window"),
+        }
+        if solver == "alm":
+            rpca_params["coreset"] = self.params.get("rpca_coreset")
+            rpca_params["coreset_sampling"] = self.params.get(
+                "rpca_coreset_sampling", "uniform"
+            )
+        rpca_params.update(self.params.get("rpca_solver_params", {}))
+        if self.params.get("rpca_window") is None:
+            if solver == "alm":
+                rpca_params["checkpoint"] = self.checkpoint
+                rpca_params["checkpoint_interval"] = self.params.get(
+                    "rpca_checkpoint_interval", 300
+                )
+            diagnostics = [RPCADiagnostics()]
+            data, noise = get_solver(solver)(
+                self.eeg_filt_eog._data, diagnostics=diagnostics[0], **rpca_params
+            )
+        else:
+            sfreq = self.eeg_filt_eog.info["sfreq"]
+            diagnostics = []
+            data, noise = rpca_windowed(
+                self.eeg_filt_eog._data,
+                int(round(self.params["rpca_window"] * sfreq)),
+                int(round(self.params.get("rpca_overlap", 1) * sfreq)),
+                self.params.get("n_jobs", 1),
+                diagnostics,
+                solver,
+                **rpca_params
+            )
+        self._store_RPCA(data, noise, diagnostics)
+        return self.eeg_filt_eog_rpca._data, self.noise
+
+    def _store_RPCA(self, data, noise, diagnostics):
+        # keeps the result of RPCA and a summary of its solves
+        self.eeg_filt_eog_rpca._data = data
+        if self.params.get("sparse_noise", False):
+            noise = sparse.csr_matrix(noise)
+        self.noise = noise
+        summaries = [solve.summary() for solve in diagnostics]
+        self.automagic["perform_RPCA"] = {"performed": True}
+        for key in summaries[0]:
+            self.automagic["perform_RPCA"][key] = [
+                summary[key] for summary in summaries
+            ]
 
     def plot(self, show=True):
         """ plot
@@ -276,13 +707,15 @@ class Preprocess:
         data = self.filtered._data
         scale_min = np.min(np.min(data))
         scale_max = np.max(np.max(data))
+        # the bad channels are marked on a shifted copy, since the filtered
+        # data is also the output in low memory mode
+        data = data - ((scale_max + scale_min) / 2)
 
         for i in range(len(self.index)):  # len(badChannels)
             # index[i] = allchan.index(badChannels[i])
-            data[(self.index[i] - 1), :] = scale_min * np.ones(
-                (self.eeg._data.shape[1])
+            data[(self.index[i] - 1), :] = (
+                (scale_min - scale_max) / 2 * np.ones((self.eeg._data.shape[1]))
             )
-        data = data - ((scale_max + scale_min) / 2)
         plt.imshow(
             data,
             aspect="auto",
@@ -345,14 +778,14 @@ class Preprocess:
         plt.title("RPCA Corrected EEG data")
 
         # RPCA Noisy Data Plot
-        self.noise = self.eeg_filt_eog_rpca.copy()
         ax = self.fig1.add_subplot(8, 1, 6)
-        self.noise._data = np.delete(self.noise._data, (self.index - 1), 0)
-        scale_min = np.min(np.min(self.noise._data))
-        scale_max = np.max(np.max(self.noise._data))
-        self.noise._data = self.noise._data - ((scale_max + scale_min) / 2)
+        noise = self.noise.toarray() if sparse.issparse(self.noise) else self.noise
+        noise = np.delete(noise, (self.index - 1), 0)
+        scale_min = np.min(np.min(noise))
+        scale_max = np.max(np.max(noise))
+        noise = noise - ((scale_max + scale_min) / 2)
         plt.imshow(
-            self.noise._data,
+            noise,
             aspect="auto",
             extent=[
                 0,
@@ -365,11 +798,9 @@ class Preprocess:
         plt.colorbar()
         plt.title("Noise")
 
-        eeg_clean = self.eeg_filt_eog_rpca.copy()
-
         self.fig2 = plt.figure(2)
         plt.setp(self.fig2, facecolor=[1, 1, 1], figwidth=15)
-        data2 = eeg_clean._data
+        data2 = self.eeg_filt_eog_rpca._data
         data2 = np.delete(data2, (self.index - 1), 0)
         scale_min = np.min(np.min(data2))
         scale_max = np.max(np.max(data2))
@@ -397,6 +828,13 @@ class Preprocess:
         """ Fit
         Perform the full preprocessing pipeline for pyautomagic (modeled from
         matlab's automagic package).
+        With params['low_memory'], the stages after prep transform the data
+        of the eeg passed to Preprocess in place instead of copies of it, so
+        filtered, eeg_filt_eog and eeg_filt_eog_rpca are the same object,
+        holding the data of the last stage performed (the plots of the
+        intermediate stages then show the final data). With
+        params['report_memory'], the peak memory (in MB) allocated by each
+        stage is stored in automagic['peak_memory'].
 
         Returns
         -------
@@ -408,29 +846,304 @@ class Preprocess:
              Figure of the final cleaned eeg data
         """
 
-        # performPrep
-        if self.automagic["prep"]["performed"] == False:
-            print("prep")
-            self.eeg.info["bads"] = self.perform_prep()
+        self.prepare_RPCA()
+        self._run_stages(["perform_RPCA"])
+
+        self.fig1, self.fig2 = self.plot()
+
+        return self.eeg_filt_eog_rpca, self.fig1, self.fig2
+
+    def prepare_RPCA(self):
+        """ prepare_RPCA
+        Performs prep, filtering and eog regression, the steps of fit before
+        RPCA, unless they were already performed. Used to run RPCA of several
+        recordings at once, see perform_RPCA_batch.
+
+        Returns
+        -------
+        eeg_filt_eog : mne.io.Raw
+            Filtered eeg data, with eog regression
+        """
+
+        self._run_stages(
+            [name for name in stage_order(self.params) if name != "perform_RPCA"]
+        )
+        return self.eeg_filt_eog
+
+    def _run_stages(self, names):
+        # performs the stages of names not performed yet, in order
+        for name in names:
+            if name not in self.performed:
+                print(name)
+                self._run_stage(name)
+
+    def _load_data(self, eeg):
+        # loads the data of eeg from the stage cache, keyed by the files it
+        # is read from (name, size and modification time) and its samples,
+        # or by its content if it was already loaded
+        if eeg.preload:
+            self.stage_keys["load"] = StageCache.key("load", eeg._data, eeg.ch_names)
+            return
+        key = StageCache.key(
+            "load", source_files(eeg), eeg.first_samp, eeg.last_samp, eeg.ch_names
+        )
+        self.stage_keys["load"] = key
+        arrays, _ = self.stage_cache.get(key)
+        if arrays is None:
+            eeg.load_data()
+            self.stage_cache.put(key, {"data": eeg._data}, {})
+        else:
+            # as mne's Raw.load_data
+            eeg._data = arrays["data"]
+            eeg.preload = True
+            eeg._comp = None
+            eeg.close()
+
+    def _run_stage(self, stage):
+        # restores the output of stage from stored_outputs, or from the stage
+        # cache if it is there under the key of the outputs of its inputs and
+        # of its parameters, or else performs it
+        inputs = STAGES[stage].get_inputs(self.params)
+        with self._stage(stage):
+            key = None
+            arrays, metadata = self.stored_outputs.get(stage, (None, None))
+            if self.stage_cache is None:
+                pass
+            elif stage == "perform_eog_regression" and "eog" not in self.filtered:
+                # nothing to regress out, the output is the filtered data
+                self.stage_keys[stage] = self.stage_keys[inputs[0]]
+            else:
+                params = {name: self.params.get(name) for name in STAGES[stage].params}
+                key = StageCache.key(
+                    [self.stage_keys[name] for name in inputs], stage, params
+                )
+                self.stage_keys[stage] = key
+                if arrays is None:
+                    arrays, metadata = self.stage_cache.get(key)
+            if arrays is None:
+                self._perform_stage(stage)
+                if key is not None:
+                    self.stage_cache.put(key, *self._stage_output(stage))
+                    self.automagic["stage_cache"][stage] = "performed"
+            else:
+                self._restore_stage(stage, arrays, metadata)
+                if key is not None:
+                    self.automagic["stage_cache"][stage] = "restored"
+        self.performed.add(stage)
+        if stage == "prep":
             self.index = np.zeros(len(self.eeg.info["bads"])).astype(int)
+        elif stage == "filtering" and "filtering" in STAGES["prep"].get_inputs(
+            self.params
+        ):
+            # prep then runs on the filtered data
+            if self.params.get("low_memory", False):
+                self.eeg = self.filtered
+            else:
+                self.eeg = self.filtered.copy()
 
-        # perfom filter
-        if self.automagic["filtering"]["performed"] == False:
-            print("filter")
+    def _perform_stage(self, stage):
+        if stage == "prep":
+            self.eeg.info["bads"] = self.perform_prep()
+        elif stage == "filtering":
             self.filtered = self.perform_filter()
-
-        # eog_regression
-        if self.automagic["perform_eog_regression"] == False:
-            print("eog_regression")
-            self.eeg_filt_eog = self.filtered.copy()
+        elif stage == "perform_eog_regression":
             self.eeg_filt_eog = self.perform_eog_regression()
+        else:
+            self.perform_RPCA()
 
-        # perform RPCA
-        if self.automagic["perform_RPCA"] == False:
-            print("rpca")
-            self.eeg_filt_eog_rpca = self.eeg_filt_eog.copy()
-            self.eeg_filt_eog_rpca._data, self.noise = self.perform_RPCA()
+    def _stage_output(self, stage):
+        # arrays and metadata of the output of stage, to store in the cache
+        if stage == "prep":
+            return {}, {"bads": self.bad_chs}
+        if stage == "filtering":
+            return (
+                {"data": self.filtered._data},
+                {"sfreq": self.filtered.info["sfreq"]},
+            )
+        if stage == "perform_eog_regression":
+            return (
+                {"data": self.eeg_filt_eog._data},
+                {
+                    "perform_eog_regression": self.automagic["perform_eog_regression"],
+                    "eog_coefficients": self.automagic.get("eog_coefficients"),
+                },
+            )
+        arrays = {"data": self.eeg_filt_eog_rpca._data}
+        if sparse.issparse(self.noise):
+            arrays.update(
+                noise_data=self.noise.data,
+                noise_indices=self.noise.indices,
+                noise_indptr=self.noise.indptr,
+            )
+        else:
+            arrays["noise"] = self.noise
+        return arrays, {"perform_RPCA": self.automagic["perform_RPCA"]}
 
-        self.fig1, self.fig2 = self.plot()
+    def _restore_stage(self, stage, arrays, metadata):
+        # sets the output of stage loaded from the cache or stored_outputs, as
+        # _perform_stage
+        low_memory = self.params.get("low_memory", False)
+        if stage == "prep":
+            self.automagic["prep"]["performed"] = True
+            self.bad_chs = metadata["bads"]
+            self.automagic.update({"auto_bad_chans": self.bad_chs})
+            self.eeg.info["bads"] = self.bad_chs
+        elif stage == "filtering":
+            self.automagic["filtering"]["performed"] = True
+            if self.params.get("resample_sfreq") is None:
+                self.filtered._data = arrays["data"]
+            else:
+                self.filtered = _resampled_raw(
+                    self.filtered, arrays["data"], metadata["sfreq"]
+                )
+        elif stage == "perform_eog_regression":
+            self.automagic["perform_eog_regression"] = metadata[
+                "perform_eog_regression"
+            ]
+            if metadata["eog_coefficients"] is not None:
+                self.automagic["eog_coefficients"] = metadata["eog_coefficients"]
+            eog_indices = mne.pick_types(self.filtered.info, eog=True, exclude=[])
+            self.eog = mne.io.RawArray(
+                self.filtered._data[eog_indices],
+                mne.pick_info(self.filtered.info, eog_indices),
+                verbose=False,
+            )
+            self.eeg_filt_eog = self.filtered if low_memory else self.filtered.copy()
+            self.eeg_filt_eog._data = arrays["data"]
+        else:
+            self.eeg_filt_eog_rpca = (
+                self.eeg_filt_eog if low_memory else self.eeg_filt_eog.copy()
+            )
+            self.eeg_filt_eog_rpca._data = arrays["data"]
+            if "noise" in arrays:
+                self.noise = arrays["noise"]
+            else:
+                self.noise = sparse.csr_matrix(
+                    (
+                        arrays["noise_data"],
+                        arrays["noise_indices"],
+                        arrays["noise_indptr"],
+                    ),
+                    shape=arrays["data"].shape,
+                )
+            self.automagic["perform_RPCA"] = metadata["perform_RPCA"]
 
-        return self.eeg_filt_eog_rpca, self.fig1, self.fig2
+    def _stage(self, name):
+        # with params['report_memory'], records the peak memory (in MB)
+        # allocated while a stage runs in automagic['peak_memory'][name]
+        if not self.params.get("report_memory", False):
+            return _no_peak_memory()
+        return _peak_memory(self.automagic.setdefault("peak_memory", {}), name)
+
+
+@contextlib.contextmanager
+def _peak_memory(peaks, name):
+    """ _peak_memory
+    Stores in peaks[name] the peak memory (in MB) traced by tracemalloc,
+    which numpy reports its arrays to, above the memory traced when the
+    block is entered.
+    """
+    tracing = tracemalloc.is_tracing()
+    if tracing and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        # before Python 3.9, the peak is only reset by restarting tracing
+        tracemalloc.stop()
+        tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    try:
+        yield
+    finally:
+        peak = tracemalloc.get_traced_memory()[1]
+        if not tracing:
+            tracemalloc.stop()
+        peaks[name] = (peak - start) / 2 ** 20
+
+
+@contextlib.contextmanager
+def _no_peak_memory():
+    # contextlib.nullcontext needs Python 3.7
+    yield
+
+
+def _resampled_raw(raw, data, sfreq):
+    """ _resampled_raw
+    Returns a raw object with the channels, montage, measurement date,
+    annotations and bad channels of raw, containing data sampled at sfreq.
+    """
+    info = mne.create_info(raw.ch_names, sfreq, raw.get_channel_types())
+    resampled = mne.io.RawArray(data, info, verbose=False)
+    # RawArray converts data to float64
+    resampled._data = data
+    resampled.set_montage(raw.get_montage())
+    resampled.set_meas_date(raw.info["meas_date"])
+    resampled.set_annotations(raw.annotations)
+    resampled.info["bads"] = list(raw.info["bads"])
+    return resampled
+
+
+def perform_RPCA_batch(preprocesses):
+    """ perform_RPCA_batch
+    Performs RPCA of several recordings of the same shape at once (see
+    rpca_batch), which is faster than one solve each for many short
+    recordings. prepare_RPCA must have been called on every Preprocess.
+    rpca_batch only implements the default solver of rpca, so if the RPCA
+    parameters differ between the recordings, or set windows, a stall
+    window, another solver or the randomized SVD, every recording
+    is solved on its own with perform_RPCA instead. Checkpoints do not apply
+    to batched solves.
+
+    Parameters
+    ----------
+    preprocesses : list of Preprocess
+        Preprocess objects whose eeg_filt_eog data all have the same shape
+
+    Returns
+    -------
+    preprocesses : list of Preprocess
+        the same objects, with RPCA performed, so that fit skips it
+    """
+
+    shapes = {preprocess.eeg_filt_eog._data.shape for preprocess in preprocesses}
+    if len(shapes) > 1:
+        raise ValueError("RPCA can only be batched over data of the same shape")
+    params = preprocesses[0].params
+    if not all(_batchable(preprocess, params) for preprocess in preprocesses):
+        for preprocess in preprocesses:
+            preprocess._run_stages(["perform_RPCA"])
+        return preprocesses
+    diagnostics = []
+    data, noise = rpca_batch(
+        np.array([preprocess.eeg_filt_eog._data for preprocess in preprocesses]),
+        params["lam"],
+        params["tol"],
+        params["max_iter"],
+        params.get("rpca_svd_method", "auto"),
+        diagnostics,
+    )
+    for k, preprocess in enumerate(preprocesses):
+        print("rpca")
+        if preprocess.params.get("low_memory", False):
+            preprocess.eeg_filt_eog_rpca = preprocess.eeg_filt_eog
+        else:
+            preprocess.eeg_filt_eog_rpca = preprocess.eeg_filt_eog.copy()
+        preprocess._store_RPCA(data[k], noise[k], diagnostics[k : k + 1])
+        preprocess.performed.add("perform_RPCA")
+    return preprocesses
+
+
+def _batchable(preprocess, params):
+    """ _batchable
+    Returns whether the RPCA of preprocess is solved by rpca_batch as
+    perform_RPCA would solve it, with the RPCA parameters params.
+    """
+    rpca_params = STAGES["perform_RPCA"].params
+    if any(preprocess.params.get(key) != params.get(key) for key in rpca_params):
+        return False
+    return (
+        params.get("rpca_solver", "alm") == "alm"
+        and not params.get("rpca_solver_params")
+        and params.get("rpca_window") is None
+        and params.get("rpca_stall_window") is None
+        and params.get("rpca_svd_method", "auto") != "randomized"
+    )
@@ -1,7 +1,53 @@
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
+# the Gram matrix path is used when there are at least this many columns per
+# row, below that a thin SVD is about as fast and numerically safer
+GRAM_RATIO = 10
+
+# singular triplets computed beyond the predicted rank by the randomized path
+N_OVERSAMPLES = 10
+
+# singular values of the low rank part of a column sample below this
+# fraction of the largest one are not part of the learned subspace
+CORESET_RTOL = 1e-6
+# a column sampled solve is only extended to every column up to this
+# relative error, its accuracy is limited by the sampled subspace anyway
+CORESET_TOL = 1e-3
+# columns extended at a time, since the columns are independent problems
+# once the subspace is fixed: the work arrays of a block stay in cache, and
+# each block stops at its own convergence
+CORESET_BLOCK = 1024
+
+# relative change of L that ends the stages of rpca_altproj before the
+# last one, which is solved to tol
+ALTPROJ_STAGE_TOL = 1e-2
+# columns of a float32 matrix cast to float64 at a time to accumulate its
+# Gram matrix
+GRAM_BLOCK = 4096
 
-def rpca(M, lam=-1, tol=1e-7, maxIter=1000):
+
+def rpca(
+    M,
+    lam=-1,
+    tol=1e-7,
+    maxIter=1000,
+    svd_method="auto",
+    state=None,
+    return_state=False,
+    diagnostics=None,
+    stall_window=None,
+    stall_rtol=1e-3,
+    checkpoint=None,
+    checkpoint_interval=300,
+    coreset=None,
+    coreset_sampling="uniform",
+):
 
     """ Perform Robust Principle Component Analysis:
 
@@ -17,13 +63,63 @@ def rpca(M, lam=-1, tol=1e-7, maxIter=1000):
     parameters
     ----------
         M : npumpy.darray
-            1st parameter, EEG Data (must include)
+            1st parameter, EEG Data (must include), float64 or float32 (the
+            solve then runs in float32)
         lam : double
             2nd parameter, Lamda paramter for RPCA (default = 1/(sqrt(# of Colunms))
         tol : double
-            3rd parameter, Tolerance (defalut = 1e-7) RPCA param
+            3rd parameter, Tolerance (defalut = 1e-7) RPCA param, at least 10
+            times the machine epsilon of the dtype of M
         maxIter : int
            fourth parameter, Maximum Iterations (deafult = 1000)
+        svd_method : str
+           fifth parameter, how the singular value threshold step is computed:
+           'svd' (thin SVD of the full matrix), 'gram' (eigendecomposition of
+           the small rows x rows Gram matrix), 'randomized' (only the
+           predicted number of leading singular triplets, see
+           randomized_svd_thres) or 'auto' (default), which uses 'gram' when
+           M has at least GRAM_RATIO times more columns than rows
+        state : dict | None
+           sixth parameter, solver state returned by a previous call with
+           return_state=True (default = None). The randomized path starts
+           from its rank. If it comes from the same M, L, the dual variable Y
+           and mu are carried over too, so that the previous solve continues
+           where it stopped (e.g. to a smaller tol). On other data they
+           restart: a large mu there would stop the solve before S becomes
+           sparse, and a small one saves no iterations
+        return_state : bool
+           seventh parameter, whether to also return the solver state
+           (default = False)
+        diagnostics : RPCADiagnostics | None
+           eighth parameter, filled in with the relative error, rank of L,
+           sparsity of S and elapsed time of every iteration (default = None)
+        stall_window : int | None
+           ninth parameter, stop early when over the last stall_window
+           iterations the rank of L did not change and the relative error
+           decreased by less than a factor stall_rtol (default = None, only
+           stop at tol or maxIter)
+        stall_rtol : double
+           tenth parameter, see stall_window (default = 1e-3)
+        checkpoint : str | None
+           eleventh parameter, path prefix of checkpoint files. If given, the
+           iteration state (L and Y as memory-mapped .npy files, the rest in
+           a .json file) is saved every checkpoint_interval seconds, and a
+           checkpoint left by an interrupted solve of the same M is resumed
+           from. The files are removed once the solve ends (default = None)
+        checkpoint_interval : double
+           twelfth parameter, seconds between checkpoints (default = 300)
+        coreset : int | double | None
+           thirteenth parameter, if given only this many columns of M (or
+           this fraction of them, if below 1) are solved, and the low rank
+           subspace and singular values learned from them are extended to
+           every column: L is the shrunk projection of M - S onto that
+           subspace and S the soft thresholded residual. An approximation,
+           for fast first passes. The state, diagnostics and checkpoints
+           apply to the solve of the sample (default = None, solve all of M)
+        coreset_sampling : str
+           fourteenth parameter, how the columns are sampled, 'uniform'
+           (default) or 'leverage' (with probability proportional to their
+           leverage scores, see column_leverage)
     return
     ------
         Data : npumpy.darray
@@ -31,47 +127,907 @@ def rpca(M, lam=-1, tol=1e-7, maxIter=1000):
         Error : npumpy.darray
             Noise removed from the data (Sparse Matrix)
             note: M = L + S
+        state : dict
+            only if return_state is True. 'basis' (orthonormal basis of the
+            columns of L), 'coef' (L = basis coef), 'rank', 'Y', 'mu', 'norm'
+            (Frobenius norm of M, identifies the data the state belongs to),
+            'n_iter' and 'warm_start' (whether this solve was warm started)
 """
+    M = _as_float(M)
+    if coreset is not None:
+        return _rpca_coreset(
+            M,
+            coreset,
+            coreset_sampling,
+            dict(
+                lam=lam,
+                tol=tol,
+                maxIter=maxIter,
+                svd_method=svd_method,
+                state=state,
+                return_state=return_state,
+                diagnostics=diagnostics,
+                stall_window=stall_window,
+                stall_rtol=stall_rtol,
+                checkpoint=checkpoint,
+                checkpoint_interval=checkpoint_interval,
+            ),
+        )
+
     # Calculate lamda if not provided using the Automagic algorithim
     Nr = M.shape[0]
     Nc = M.shape[1]
     if lam == -1:  # if no input lamda, calculate its value
         lam = 1 / np.sqrt(Nc)
+    if svd_method == "auto":
+        svd_method = "gram" if Nc >= GRAM_RATIO * Nr else "svd"
+    if svd_method not in ("svd", "gram", "randomized"):
+        raise ValueError("svd_method must be 'auto', 'svd', 'gram' or 'randomized'")
 
-    norm_2 = np.linalg.norm(M, 2)
-    norm_inf = np.linalg.norm(M, np.inf) / lam
-    dual_norm = np.maximum(norm_2, norm_inf)
+    # the iterations run in the dtype of M (e.g. float32), with python float
+    # scalars which do not promote it; the residual cannot get below the
+    # resolution of that dtype
+    tol = max(tol, 10 * np.finfo(M.dtype).eps)
+    norm_2 = float(np.linalg.norm(M, 2))
+    norm_inf = float(np.linalg.norm(M, np.inf)) / lam
+    dual_norm = max(norm_2, norm_inf)
     Y = M / dual_norm
 
     mu = 1.25 / norm_2
     mu_bar = mu * 1e7
     rho = 1.5
 
-    L = np.zeros((Nr, Nc))
-    S = np.zeros((Nr, Nc))
+    # every full-size array used by the iterations is allocated here once,
+    # and updated in place below
+    L = np.zeros((Nr, Nc), M.dtype)
+    S = np.zeros((Nr, Nc), M.dtype)
+    T = np.empty((Nr, Nc), M.dtype)
+    Y_mu = np.empty((Nr, Nc), M.dtype)
+
+    # predicted rank of L for the randomized path (inexact ALM, Lin et al. 2010)
+    n = min(Nr, Nc)
+    sv = min(10, n)
+    rng = np.random.RandomState(0)
+
+    norm_fro = float(np.linalg.norm(M, "fro"))
+    if state is not None:
+        if state["Y"] is not None and state["norm"] == norm_fro:
+            # same data, continue the previous solve
+            basis = state["basis"].astype(M.dtype, copy=False)
+            np.dot(basis, state["coef"].astype(M.dtype, copy=False), out=L)
+            np.copyto(Y, state["Y"])
+            mu = np.clip(state["mu"], mu, mu_bar)
+        sv = min(max(state["rank"], 1), n)
 
-    error = 10
     count = 0
+    if checkpoint is not None:
+        meta = {
+            "shape": [Nr, Nc],
+            "norm": float(norm_fro),
+            "lam": float(lam),
+            "svd_method": svd_method,
+        }
+        resumed = _load_checkpoint(checkpoint, meta)
+        if resumed is not None:
+            np.copyto(L, resumed["L"])
+            np.copyto(Y, resumed["Y"])
+            mu = resumed["mu"]
+            count = resumed["count"]
+            sv = resumed["sv"]
+            rng.set_state(resumed["rng"])
+        last_checkpoint = time.perf_counter()
+
+    start_time = time.perf_counter()
+    history = deque(maxlen=(stall_window or 0) + 1)
+    stop_reason = "converged"
+
+    error = 10
     isRunning = True
     while isRunning and error > tol:
-        temp_t = M - L + (Y / mu)
-        S = soft_thres(temp_t, lam / mu)
-        U, sig, V = np.linalg.svd(M - S + (Y / mu), full_matrices=False)
-        L = np.dot(U, np.dot(np.diag(soft_thres(sig, 1 / mu)), V))
-        Y = Y + mu * (M - L - S)
+        # S = ST(M - L + Y / mu, lam / mu)
+        np.divide(Y, mu, out=Y_mu)
+        np.subtract(M, L, out=T)
+        np.add(T, Y_mu, out=T)
+        soft_thres(T, lam / mu, out=S)
+        # L = SVT(M - S + Y / mu, 1 / mu)
+        np.subtract(M, S, out=T)
+        np.add(T, Y_mu, out=T)
+        if svd_method == "randomized":
+            L, svp = randomized_svd_thres(T, 1 / mu, sv, rng, out=L)
+            if svp < sv:
+                sv = min(svp + 1, n)
+            else:
+                sv = min(svp + int(round(0.05 * n)), n)
+        else:
+            L, svp = svd_thres(T, 1 / mu, svd_method, out=L, return_rank=True)
+        # Y = Y + mu * (M - L - S)
+        np.subtract(M, L, out=T)
+        np.subtract(T, S, out=T)
+        np.multiply(mu, T, out=Y_mu)
+        np.add(Y, Y_mu, out=Y)
         mu = np.minimum(mu * rho, mu_bar)
-        error = np.linalg.norm(M - L - S, "fro") / np.linalg.norm(M, "fro")
+        error = float(np.linalg.norm(T, "fro")) / norm_fro
         count += 1
+        if diagnostics is not None:
+            diagnostics.record(
+                error,
+                svp,
+                1 - np.count_nonzero(S) / S.size,
+                time.perf_counter() - start_time,
+            )
+        history.append((error, svp))
+        if stall_window and _stalled(history, stall_rtol) and error > tol:
+            isRunning = False
+            stop_reason = "stalled"
         if count >= maxIter:
             isRunning = False
+            if error > tol:
+                stop_reason = "max_iter"
+        if (
+            checkpoint is not None
+            and isRunning
+            and error > tol
+            and time.perf_counter() - last_checkpoint >= checkpoint_interval
+        ):
+            _save_checkpoint(checkpoint, meta, L, Y, mu, count, sv, rng)
+            last_checkpoint = time.perf_counter()
+
+    if diagnostics is not None:
+        diagnostics.stop_reason = stop_reason
+    if checkpoint is not None:
+        _remove_checkpoint(checkpoint, meta)
 
     Data = L.reshape(Nr, Nc)
     Error = S.reshape(Nr, Nc)
 
+    if return_state:
+        basis = low_rank_basis(Data)
+        state = {
+            "basis": basis,
+            "coef": np.dot(basis.T, Data),
+            "rank": basis.shape[1],
+            "Y": Y,
+            "mu": float(mu),
+            "norm": norm_fro,
+            "n_iter": count,
+            "warm_start": state is not None,
+        }
+        return Data, Error, state
     return Data, Error
 
 
-def soft_thres(x, eps):
+def rpca_altproj(
+    M,
+    lam=-1,
+    tol=1e-7,
+    maxIter=1000,
+    svd_method="auto",
+    state=None,
+    return_state=False,
+    diagnostics=None,
+    stall_window=None,
+    stall_rtol=1e-3,
+    rank=None,
+):
+
+    """ Perform Robust Principle Component Analysis by alternating projections
+
+    Non-convex RPCA (AltProj, Netrapalli et al. 2014): L is alternately
+    projected onto the matrices of rank k (truncated SVD of M - S) and S
+    onto the sparse matrices (hard thresholding of M - L), with a threshold
+    that decreases with the (k+1)th singular value of M - S. The rank k
+    grows by one per stage, up to rank, and stops early once the next
+    singular value is negligible. Each iteration only needs the k+1 leading
+    singular values, so it is cheaper than an iteration of rpca, and
+    exactly low rank data is recovered to much higher accuracy, but the
+    rank must be bounded for it to pay off.
+
+    Takes the same arguments as rpca, except for the ones specific to the
+    convex solver (checkpoint, coreset), see SOLVERS.
+
+    parameters
+    ----------
+        M : npumpy.darray
+            1st parameter, EEG Data (must include)
+        lam : double
+            2nd parameter, scale of the hard threshold relative to the
+            singular values (default = 1/(sqrt(# of Colunms))
+        tol : double
+            3rd parameter, the last stage stops when L changes by less than
+            tol relative to M (defalut = 1e-7)
+        maxIter : int
+            4th parameter, maximum number of iterations over all stages
+            (default = 1000)
+        svd_method : str
+            5th parameter, how the leading singular triplets are computed,
+            'svd', 'gram', 'randomized' or 'auto' (default), see rpca
+        state : dict | None
+            6th parameter, solver state of a previous call, the stages start
+            from its rank (default = None)
+        return_state : bool
+            7th parameter, whether to also return the solver state
+            (default = False)
+        diagnostics : RPCADiagnostics | None
+            8th parameter, filled in every iteration, with the relative
+            change of L as the error (default = None)
+        stall_window : int | None
+            9th parameter, see rpca (default = None)
+        stall_rtol : double
+            10th parameter, see rpca (default = 1e-3)
+        rank : int | None
+            11th parameter, largest rank of L (default = None, up to
+            min(# of Rows, # of Columns))
+    return
+    ------
+        Data : npumpy.darray
+            Corrected Data (Low rank matrix)
+        Error : npumpy.darray
+            Noise removed from the data (Sparse Matrix)
+        state : dict
+            only if return_state is True, see rpca. 'Y' and 'mu' are None
+    """
+    M = _as_float(M)
+    Nr, Nc = M.shape
+    n = min(Nr, Nc)
+    if lam == -1:
+        lam = 1 / np.sqrt(Nc)
+    if svd_method == "auto":
+        svd_method = "gram" if Nc >= GRAM_RATIO * Nr else "svd"
+    if svd_method not in ("svd", "gram", "randomized"):
+        raise ValueError("svd_method must be 'auto', 'svd', 'gram' or 'randomized'")
+    rank = n if rank is None else min(rank, n)
+    rng = np.random.RandomState(0)
+    tol = max(tol, 10 * np.finfo(M.dtype).eps)
+
+    L = np.zeros((Nr, Nc), M.dtype)
+    L_prev = np.empty((Nr, Nc), M.dtype)
+    S = np.empty((Nr, Nc), M.dtype)
+    T = np.empty((Nr, Nc), M.dtype)
+    norm_fro = float(np.linalg.norm(M, "fro"))
+    # the largest entries of M are outliers of any low rank part
+    hard_thres(M, lam * float(np.linalg.norm(M, 2)), out=S)
+
+    start_time = time.perf_counter()
+    history = deque(maxlen=(stall_window or 0) + 1)
+    stop_reason = "converged"
+    count = 0
+    k = 1 if state is None else min(max(state["rank"], 1), rank)
+    isRunning = True
+    while isRunning:
+        stage_tol = tol if k == rank else max(tol, ALTPROJ_STAGE_TOL)
+        t = 0
+        error = 10
+        while isRunning and error > stage_tol:
+            # L = P_k(M - S), S = HT(M - L, zeta)
+            np.copyto(L_prev, L)
+            np.subtract(M, S, out=T)
+            L, sig = _truncated_svd(T, k, svd_method, rng, out=L)
+            zeta = lam * (sig[k] + 0.5 ** t * sig[k - 1])
+            np.subtract(M, L, out=T)
+            hard_thres(T, zeta, out=S)
+            np.subtract(L, L_prev, out=T)
+            error = float(np.linalg.norm(T, "fro")) / norm_fro
+            t += 1
+            count += 1
+            if diagnostics is not None:
+                diagnostics.record(
+                    error,
+                    k,
+                    1 - np.count_nonzero(S) / S.size,
+                    time.perf_counter() - start_time,
+                )
+            history.append((error, k))
+            if stall_window and _stalled(history, stall_rtol) and error > stage_tol:
+                isRunning = False
+                stop_reason = "stalled"
+            if count >= maxIter:
+                isRunning = False
+                if error > stage_tol or k < rank:
+                    stop_reason = "max_iter"
+        # the next stage is only needed if the (k+1)th singular value of
+        # M - S is not negligible
+        if k == rank or sig[k] <= tol * sig[0]:
+            isRunning = False
+        k += 1
+
+    if diagnostics is not None:
+        diagnostics.stop_reason = stop_reason
+
+    if return_state:
+        basis = low_rank_basis(L)
+        state = {
+            "basis": basis,
+            "coef": np.dot(basis.T, L),
+            "rank": basis.shape[1],
+            "Y": None,
+            "mu": None,
+            "norm": norm_fro,
+            "n_iter": count,
+            "warm_start": state is not None,
+        }
+        return L, S, state
+    return L, S
+
+
+def _truncated_svd(X, k, svd_method, random_state, out=None):
+    # best rank k approximation of X, written into out, and the k+1 leading
+    # singular values of X (zero padded)
+    n = min(X.shape)
+    if svd_method == "randomized" and k + 1 + N_OVERSAMPLES < n:
+        # range of X as in randomized_svd_thres
+        omega = random_state.randn(X.shape[1], k + 1 + N_OVERSAMPLES)
+        Q, _ = np.linalg.qr(np.dot(X, omega.astype(X.dtype, copy=False)))
+        for _ in range(2):
+            Q, _ = np.linalg.qr(np.dot(X, np.dot(X.T, Q)))
+        B = np.dot(Q.T, X)
+        w, U = _gram_eigh(B)
+        U = np.dot(Q, U[:, ::-1])
+    elif svd_method == "svd":
+        U, sig, V = np.linalg.svd(X, full_matrices=False)
+        L = np.dot(U[:, :k] * sig[:k], V[:k], out=out)
+        return L, np.append(sig, 0)[: k + 1]
+    else:
+        w, U = _gram_eigh(X)
+        U = U[:, ::-1]
+    sig = np.sqrt(np.maximum(w[::-1], 0))
+    U = U[:, :k]
+    L = np.dot(U, np.dot(U.T, X), out=out)
+    return L, np.append(sig, 0)[: k + 1]
+
+
+def _as_float(M):
+    # float32 data is solved in float32, anything else (e.g. integers) in
+    # float64
+    return M if M.dtype == np.float32 else M.astype(np.float64, copy=False)
+
+
+def _gram_eigh(X):
+    # eigendecomposition of the small Gram matrix X X^T (of every matrix of
+    # X, if it is a stack) in double precision, since squaring X already
+    # halves the accurate digits: for a float32 X it is accumulated over
+    # blocks of GRAM_BLOCK columns cast to float64 (eigenvectors cast back
+    # to the dtype of X)
+    if X.dtype == np.float64:
+        G = np.matmul(X, X.swapaxes(-1, -2))
+    else:
+        G = np.zeros(X.shape[:-1] + X.shape[-2:-1])
+        for start in range(0, X.shape[-1], GRAM_BLOCK):
+            block = X[..., start : start + GRAM_BLOCK].astype(np.float64)
+            G += np.matmul(block, block.swapaxes(-1, -2))
+    w, U = np.linalg.eigh(G)
+    return w, U.astype(X.dtype, copy=False)
+
+
+def _stalled(history, stall_rtol):
+    # whether over the whole history the rank did not change and the error
+    # decreased by less than a factor stall_rtol
+    error, rank = history[-1]
+    return (
+        len(history) == history.maxlen
+        and all(r == rank for _, r in history)
+        and error > (1 - stall_rtol) * history[0][0]
+    )
+
+
+def _rpca_coreset(M, coreset, sampling, kwargs):
+    # rpca of a sample of the columns of M, extended to all of them
+    Nr, Nc = M.shape
+    n_columns = int(round(coreset * Nc)) if coreset < 1 else int(coreset)
+    n_columns = min(max(n_columns, 1), Nc)
+    if sampling == "uniform":
+        p = np.full(Nc, 1 / Nc)
+    elif sampling == "leverage":
+        p = column_leverage(M)
+        p /= np.sum(p)
+    else:
+        raise ValueError("coreset_sampling must be 'uniform' or 'leverage'")
+    rng = np.random.RandomState(0)
+    columns = np.sort(rng.choice(Nc, n_columns, replace=False, p=p))
+    lam = kwargs["lam"]
+    if lam == -1:
+        lam = 1 / np.sqrt(Nc)
+    else:
+        # the same weight relative to the default lam of the sample
+        kwargs = dict(kwargs, lam=lam * np.sqrt(Nc / n_columns))
+    solve = rpca(M[:, columns], **kwargs)
+
+    # the columns of the sample, weighted by their inverse sampling
+    # probability, estimate L L^T = U diag(sig^2) U^T of the full solve
+    weights = (1 / np.sqrt(n_columns * p[columns])).astype(M.dtype)
+    U, sig, _ = np.linalg.svd(solve[0] * weights, full_matrices=False)
+    keep = sig > CORESET_RTOL * sig[0]
+    U, sig = U[:, keep], sig[keep]
+
+    # with U and sig fixed, |L|_* = min over D of tr(L^T D^-1 L) / 2 + tr(D) / 2
+    # is reached at D = U diag(sig) U^T, so the full problem separates into
+    # columns, and its SVT step becomes a shrinkage of the coefficients of
+    # L on U by sig mu / (1 + sig mu). The subspace, not the stopping
+    # tolerance, limits the accuracy, so the iterations stop at CORESET_TOL
+    tol = max(kwargs["tol"], CORESET_TOL)
+    norm_2 = float(np.linalg.norm(M, 2))
+    dual_norm = max(norm_2, float(np.linalg.norm(M, np.inf)) / lam)
+    L = np.empty((Nr, Nc), M.dtype)
+    S = np.empty((Nr, Nc), M.dtype)
+    for start in range(0, Nc, CORESET_BLOCK):
+        block = slice(start, start + CORESET_BLOCK)
+        L[:, block], S[:, block] = _extend_coreset(
+            np.ascontiguousarray(M[:, block]),
+            U,
+            sig,
+            lam,
+            tol,
+            kwargs["maxIter"],
+            norm_2,
+            dual_norm,
+        )
+    return (L, S) + tuple(solve[2:])
+
+
+def _extend_coreset(M, U, sig, lam, tol, maxIter, norm_2, dual_norm):
+    # the ALM iterations of rpca on the columns M, with the SVT step replaced
+    # by the shrinkage onto U, and the starting Y and mu of the full matrix
+    Y = M / dual_norm
+    mu = 1.25 / norm_2
+    mu_bar = mu * 1e7
+    rho = 1.5
+    L = np.zeros(M.shape, M.dtype)
+    S = np.zeros(M.shape, M.dtype)
+    T = np.empty(M.shape, M.dtype)
+    Y_mu = np.empty(M.shape, M.dtype)
+    norm_fro = float(np.linalg.norm(M, "fro"))
+    error = 10 if norm_fro > 0 else 0
+    count = 0
+    while error > tol and count < maxIter:
+        # S = ST(M - L + Y / mu, lam / mu)
+        np.divide(Y, mu, out=Y_mu)
+        np.subtract(M, L, out=T)
+        np.add(T, Y_mu, out=T)
+        soft_thres(T, lam / mu, out=S)
+        # L = U diag(sig mu / (1 + sig mu)) U^T (M - S + Y / mu)
+        np.subtract(M, S, out=T)
+        np.add(T, Y_mu, out=T)
+        np.dot(U * (sig * mu / (1 + sig * mu)), np.dot(U.T, T), out=L)
+        # Y = Y + mu * (M - L - S)
+        np.subtract(M, L, out=T)
+        np.subtract(T, S, out=T)
+        np.multiply(mu, T, out=Y_mu)
+        np.add(Y, Y_mu, out=Y)
+        # python floats, which do not promote a float32 M
+        mu = min(mu * rho, mu_bar)
+        error = float(np.linalg.norm(T, "fro")) / norm_fro
+        count += 1
+    return L, S
+
+
+def column_leverage(M):
+
+    """ Leverage scores of the columns of M
+
+    The leverage of column j is m_j^T (M M^T)^+ m_j, its squared norm in
+    the row space of M after whitening, computed from the eigendecomposition
+    of the rows x rows Gram matrix. Columns far from the others in some
+    direction, which a uniform sample would likely miss, have high leverage.
+
+    parameters
+    ----------
+        M : npumpy.darray
+            first parameter, matrix whose columns are scored
+
+    return
+    ------
+        leverage : npumpy.darray
+            leverage of every column, summing to the rank of M
+    """
+    w, U = np.linalg.eigh(np.dot(M, M.T))
+    keep = w > np.max(w) * 1e-12
+    Z = np.dot((U[:, keep] / np.sqrt(w[keep])).T, M)
+    return np.sum(Z ** 2, axis=0)
+
+
+def rpca_windowed(
+    M, window, overlap=0, n_jobs=1, diagnostics=None, solver="alm", **kwargs,
+):
+
+    """ Perform Robust Principle Component Analysis on overlapping time windows
+
+    Splits M into windows of `window` columns that overlap by `overlap`
+    columns, solves rpca on each window independently (across a process
+    pool if n_jobs > 1) and blends the L and S parts of adjacent windows
+    with a linear cross-fade over their overlap. The solver only ever holds
+    one window per worker, so its memory is bounded by the window size
+    rather than by the recording length.
+
+    Since each window is its own problem, the default lam is
+    1 / sqrt(window) rather than 1 / sqrt(# of Columns of M).
+
+    parameters
+    ----------
+        M : npumpy.darray
+            1st parameter, EEG Data (must include)
+        window : int
+            2nd parameter, number of columns (samples) per window
+        overlap : int
+            3rd parameter, number of columns shared by adjacent windows,
+            must be smaller than window (default = 0)
+        n_jobs : int
+            4th parameter, number of worker processes, -1 for all CPUs
+            (default = 1, no pool)
+        diagnostics : list | None
+            5th parameter, if given the RPCADiagnostics of every window are
+            appended to it, in time order (default = None)
+        solver : str
+            6th parameter, name of the solver in SOLVERS (default = 'alm',
+            rpca)
+        **kwargs
+            passed on to the solver (lam, tol, maxIter, svd_method,
+            stall_window, stall_rtol and its own options).
+            Windows are not checkpointed, since each of them is a short solve
+    return
+    ------
+        Data : npumpy.darray
+            Corrected Data (Low rank matrix)
+        Error : npumpy.darray
+            Noise removed from the data (Sparse Matrix)
+    """
+    M = _as_float(M)
+    Nr, Nc = M.shape
+    if not 0 <= overlap < window:
+        raise ValueError("overlap must be at least 0 and smaller than window")
+    get_solver(solver)
+    if diagnostics is None:
+        diagnostics = []
+    if Nc <= window:
+        Data, Error, window_diagnostics = _rpca_window(M, solver, kwargs)
+        diagnostics.append(window_diagnostics)
+        return Data, Error
+
+    step = window - overlap
+    starts = list(range(0, Nc - window, step)) + [Nc - window]
+    # cross-fade: each window ramps up over its overlap with the previous
+    # window and down over its overlap with the next one, and the weighted
+    # sum is normalized by the total weight of every column
+    weights = np.zeros(Nc, M.dtype)
+    Data = np.zeros((Nr, Nc), M.dtype)
+    Error = np.zeros((Nr, Nc), M.dtype)
+
+    def blend(start, L, S, window_diagnostics):
+        w = np.ones(window)
+        idx = starts.index(start)
+        if idx > 0:
+            n_ramp = starts[idx - 1] + window - start
+            w[:n_ramp] = np.arange(1, n_ramp + 1) / (n_ramp + 1)
+        if idx < len(starts) - 1:
+            n_ramp = start + window - starts[idx + 1]
+            w[window - n_ramp :] = np.arange(n_ramp, 0, -1) / (n_ramp + 1)
+        weights[start : start + window] += w
+        Data[:, start : start + window] += L * w
+        Error[:, start : start + window] += S * w
+        diagnostics.append(window_diagnostics)
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1:
+        for start in starts:
+            blend(start, *_rpca_window(M[:, start : start + window], solver, kwargs))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [
+                pool.submit(_rpca_window, M[:, start : start + window], solver, kwargs)
+                for start in starts
+            ]
+            for start, future in zip(starts, futures):
+                blend(start, *future.result())
+
+    Data /= weights
+    Error /= weights
+    return Data, Error
+
+
+def _rpca_window(M, solver, kwargs):
+    # rpca on one window, returning its diagnostics
+    diagnostics = RPCADiagnostics()
+    Data, Error = get_solver(solver)(M, diagnostics=diagnostics, **kwargs)
+    return Data, Error, diagnostics
+
+
+def rpca_batch(M, lam=-1, tol=1e-7, maxIter=1000, svd_method="auto", diagnostics=None):
+
+    """ Perform Robust Principle Component Analysis on a stack of matrices at once
+
+    Runs the iterations of rpca for every matrix of the stack together,
+    with stacked SVDs (or eigendecompositions of the Gram matrices), so
+    that many short recordings or epochs of the same shape pay the Python
+    and LAPACK call overhead once per iteration instead of once per
+    matrix. Each matrix stops at its own convergence, and only the ones
+    still running are updated.
+
+    parameters
+    ----------
+        M : npumpy.darray
+            1st parameter, stack of EEG Data of shape
+            (# of Matrices, # of Rows, # of Columns) (must include)
+        lam : double
+            2nd parameter, weight on sparse error term in the cost function,
+            the same for every matrix (default = 1 / sqrt(# of Columns))
+        tol : double
+            3rd parameter, tolerance for stopping criterion (default = 1e-7)
+        maxIter : int
+            4th parameter, maximum number of iterations (default = 1000)
+        svd_method : str
+            5th parameter, 'svd', 'gram' or 'auto' (default), see rpca.
+            The randomized path is not batched
+        diagnostics : list | None
+            6th parameter, if given the RPCADiagnostics of every matrix are
+            appended to it, in stack order (default = None)
+
+    return
+    ------
+        Data : npumpy.darray
+            Corrected Data (Low rank matrices), same shape as M
+        Error : npumpy.darray
+            Noise removed from the data (Sparse Matrices), same shape as M
+    """
+    if M.ndim != 3:
+        raise ValueError(
+            "M must be a stack of matrices (# of Matrices, # of Rows, # of Columns)"
+        )
+    M = _as_float(M)
+    Nb, Nr, Nc = M.shape
+    if lam == -1:
+        lam = 1 / np.sqrt(Nc)
+    if svd_method == "auto":
+        svd_method = "gram" if Nc >= GRAM_RATIO * Nr else "svd"
+    if svd_method not in ("svd", "gram"):
+        raise ValueError("svd_method must be 'auto', 'svd' or 'gram'")
+    # as in rpca, the iterations run in the dtype of M
+    tol = max(tol, 10 * np.finfo(M.dtype).eps)
+
+    norm_2 = np.linalg.norm(M, 2, axis=(1, 2))
+    norm_inf = np.linalg.norm(M, np.inf, axis=(1, 2)) / lam
+    dual_norm = np.maximum(norm_2, norm_inf)
+    Y = M / dual_norm[:, np.newaxis, np.newaxis]
+
+    mu = 1.25 / norm_2
+    mu_bar = mu * 1e7
+    rho = 1.5
+
+    L = np.zeros((Nb, Nr, Nc), M.dtype)
+    S = np.zeros((Nb, Nr, Nc), M.dtype)
+    T = np.empty((Nb, Nr, Nc), M.dtype)
+    Y_mu = np.empty((Nb, Nr, Nc), M.dtype)
+    norm_fro = np.linalg.norm(M, "fro", axis=(1, 2))
+
+    item_diagnostics = [RPCADiagnostics() for _ in range(Nb)]
+    if diagnostics is not None:
+        diagnostics.extend(item_diagnostics)
+    start_time = time.perf_counter()
+
+    # the iterations run in place on the matrices that have not converged
+    # yet, which are gathered into smaller arrays whenever some converge
+    active = np.arange(Nb)
+    Ma, La, Sa, Ya = M, L, S, Y
+    count = 0
+    while active.size:
+        mu_a = mu[active][:, np.newaxis, np.newaxis]
+        # S = ST(M - L + Y / mu, lam / mu)
+        np.divide(Ya, mu_a, out=Y_mu)
+        np.subtract(Ma, La, out=T)
+        np.add(T, Y_mu, out=T)
+        soft_thres(T, lam / mu_a, out=Sa)
+        # L = SVT(M - S + Y / mu, 1 / mu)
+        np.subtract(Ma, Sa, out=T)
+        np.add(T, Y_mu, out=T)
+        La, svp = _svd_thres_batch(T, 1 / mu[active], svd_method, out=La)
+        # Y = Y + mu * (M - L - S)
+        np.subtract(Ma, La, out=T)
+        np.subtract(T, Sa, out=T)
+        np.multiply(mu_a, T, out=Y_mu)
+        np.add(Ya, Y_mu, out=Ya)
+        mu[active] = np.minimum(mu[active] * rho, mu_bar[active])
+        error = np.linalg.norm(T, "fro", axis=(1, 2)) / norm_fro[active]
+        count += 1
+        elapsed = time.perf_counter() - start_time
+        sparsity = 1 - np.count_nonzero(Sa, axis=(1, 2)) / (Nr * Nc)
+        for k, item in enumerate(active):
+            item_diagnostics[item].record(error[k], svp[k], sparsity[k], elapsed)
+        done = error <= tol
+        for item in active[done]:
+            item_diagnostics[item].stop_reason = "converged"
+        if count >= maxIter:
+            for item in active[~done]:
+                item_diagnostics[item].stop_reason = "max_iter"
+            done[:] = True
+        if done.any():
+            L[active[done]] = La[done]
+            S[active[done]] = Sa[done]
+            keep = ~done
+            active = active[keep]
+            Ma, La, Sa, Ya = Ma[keep], La[keep], Sa[keep], Ya[keep]
+            T = T[: active.size]
+            Y_mu = Y_mu[: active.size]
+
+    return L, S
+
+
+def _svd_thres_batch(X, eps, svd_method, out=None):
+    # svd_thres of every matrix of the stack X at its own eps, returning
+    # the rank of every thresholded matrix
+    eps = eps[:, np.newaxis]
+    if svd_method == "gram":
+        w, U = _gram_eigh(X)
+        sig = np.sqrt(np.maximum(w, 0)).astype(X.dtype)
+        keep = sig > eps
+        scale = np.divide(soft_thres(sig, eps), sig, out=np.zeros_like(sig), where=keep)
+        L = np.matmul(
+            U * scale[:, np.newaxis, :], np.matmul(U.transpose(0, 2, 1), X), out=out
+        )
+    else:
+        U, sig, V = np.linalg.svd(X, full_matrices=False)
+        V *= soft_thres(sig, eps)[:, :, np.newaxis]
+        L = np.matmul(U, V, out=out)
+    return L, np.sum(sig > eps, axis=1)
+
+
+def _save_checkpoint(prefix, meta, L, Y, mu, count, sv, rng):
+    # L and Y go to one of two slots of memory-mapped files, alternating, and
+    # the json naming the slot is replaced last, so a solve interrupted while
+    # saving still has the previous checkpoint to resume from
+    previous = _read_checkpoint_json(prefix)
+    slot = 1 - previous["slot"] if previous is not None else 0
+    for name, array in (("L", L), ("Y", Y)):
+        saved = np.lib.format.open_memmap(
+            f"{prefix}_{name}{slot}.npy",
+            mode="w+",
+            dtype=array.dtype,
+            shape=array.shape,
+        )
+        saved[:] = array
+        saved.flush()
+        del saved
+    rng_state = rng.get_state()
+    content = dict(
+        meta,
+        slot=slot,
+        mu=float(mu),
+        count=count,
+        sv=sv,
+        rng=[rng_state[0], rng_state[1].tolist()] + list(rng_state[2:]),
+    )
+    with open(prefix + ".json.tmp", "w") as fid:
+        json.dump(content, fid)
+    os.replace(prefix + ".json.tmp", prefix + ".json")
+
+
+def _read_checkpoint_json(prefix):
+    if not os.path.isfile(prefix + ".json"):
+        return None
+    with open(prefix + ".json") as fid:
+        return json.load(fid)
+
+
+def _checkpoint_matches(content, meta):
+    return content is not None and all(
+        content.get(key) == value for key, value in meta.items()
+    )
+
+
+def _load_checkpoint(prefix, meta):
+    # the checkpoint is only used if it belongs to the same problem
+    content = _read_checkpoint_json(prefix)
+    if not _checkpoint_matches(content, meta):
+        return None
+    slot = content["slot"]
+    name, keys, *rest = content["rng"]
+    return {
+        "L": np.load(f"{prefix}_L{slot}.npy", mmap_mode="r"),
+        "Y": np.load(f"{prefix}_Y{slot}.npy", mmap_mode="r"),
+        "mu": content["mu"],
+        "count": content["count"],
+        "sv": content["sv"],
+        "rng": (name, np.array(keys, dtype=np.uint32), *rest),
+    }
+
+
+def _remove_checkpoint(prefix, meta):
+    # a checkpoint of another problem saved at the same path is kept for it
+    # to resume from
+    if not _checkpoint_matches(_read_checkpoint_json(prefix), meta):
+        return
+    for fname in [prefix + ".json"] + [
+        f"{prefix}_{name}{slot}.npy" for name in ("L", "Y") for slot in (0, 1)
+    ]:
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+
+class RPCADiagnostics:
+    """Per-iteration record of an rpca solve
+
+    Pass an instance as rpca(..., diagnostics=...) to find out how a solve
+    went, e.g. whether it converged or ran into maxIter.
+
+    Attributes
+    ----------
+    error : list
+        relative error ||M - L - S||_F / ||M||_F after every iteration
+    rank : list
+        rank of L after every iteration
+    sparsity : list
+        fraction of exactly zero entries of S after every iteration
+    elapsed : list
+        seconds since the start of the solve after every iteration
+    stop_reason : str | None
+        'converged' (error below tol), 'stalled' (see stall_window in rpca)
+        or 'max_iter', None before the solve ends
+    """
+
+    def __init__(self):
+        self.error = []
+        self.rank = []
+        self.sparsity = []
+        self.elapsed = []
+        self.stop_reason = None
+
+    def record(self, error, rank, sparsity, elapsed):
+        """Appends the values of one iteration."""
+        self.error.append(float(error))
+        self.rank.append(int(rank))
+        self.sparsity.append(float(sparsity))
+        self.elapsed.append(float(elapsed))
+
+    def summary(self):
+        """Final values of the solve, as a JSON serializable dict.
+
+        Returns
+        -------
+        summary : dict
+            n_iter, error, rank, sparsity, elapsed and stop_reason
+        """
+
+        def last(values):
+            return values[-1] if values else None
+
+        return {
+            "n_iter": len(self.error),
+            "error": last(self.error),
+            "rank": last(self.rank),
+            "sparsity": last(self.sparsity),
+            "elapsed": last(self.elapsed),
+            "stop_reason": self.stop_reason,
+        }
+
+
+def low_rank_basis(L, rtol=1e-10):
+
+    """ Orthonormal basis of the column space of a low rank matrix L
+
+    parameters
+    ----------
+        L : npumpy.darray
+            first parameter, low rank matrix
+        rtol : double
+            second parameter, singular values below rtol times the largest
+            one are treated as zero (default = 1e-10)
+
+    return
+    ------
+        basis : npumpy.darray
+            rows x rank matrix with orthonormal columns
+    """
+    if L.shape[1] >= L.shape[0]:
+        # wide L: singular values from the small Gram matrix, as in svd_thres,
+        # which are only accurate to sqrt(machine eps) of the largest one
+        w, U = _gram_eigh(L)
+        sig = np.sqrt(np.maximum(w, 0))
+        rtol = max(rtol, np.sqrt(np.finfo(L.dtype).eps))
+    else:
+        U, sig, _ = np.linalg.svd(L, full_matrices=False)
+    if sig.size == 0 or sig.max() == 0:
+        return U[:, :0]
+    return U[:, sig > rtol * sig.max()]
+
+
+def soft_thres(x, eps, out=None):
 
     """ Cian Scannell - Oct-2017
     Soft thresholds a matrix x at the eps level
@@ -83,13 +1039,180 @@ def soft_thres(x, eps):
             first parameter, values to be thersholded
         eps : double
             second parameter, thershold
+        out : npumpy.darray | None
+            third parameter, array (other than x) the result is written
+            into (default = None, a new array)
 
     return
     ------
-        np.multiply(a,b) : npumpy.darray
+        out : npumpy.darray
             thersholded values, where anythign under the threshold
             was set to zero
     """
-    a = np.sign(x)
-    b = np.maximum((np.fabs(x) - eps), 0)
-    return np.multiply(a, b)
+    out = np.fabs(x, out=out)
+    np.subtract(out, eps, out=out)
+    np.maximum(out, 0, out=out)
+    return np.copysign(out, x, out=out)
+
+
+def hard_thres(x, eps, out=None):
+
+    """ Hard thresholds a matrix x at the eps level
+    i.e HT(x,eps)_ij = x_ij if |x_ij| > eps, else 0
+
+    parameters
+    ----------
+        x : npumpy.darray
+            first parameter, values to be thersholded
+        eps : double
+            second parameter, thershold
+        out : npumpy.darray | None
+            third parameter, array (other than x) the result is written
+            into (default = None, a new array)
+
+    return
+    ------
+        out : npumpy.darray
+            thersholded values
+    """
+    return np.multiply(x, np.fabs(x) > eps, out=out)
+
+
+def svd_thres(X, eps, svd_method="svd", out=None, return_rank=False):
+
+    """ Singular value thresholding of a matrix X at the eps level
+    i.e. SVT(X, eps) = U ST(sig, eps) V, where X = U diag(sig) V
+
+    With svd_method='gram' the singular values and left singular vectors
+    are taken from the eigendecomposition of X X^T, which for a wide
+    channels x samples matrix is much cheaper than a thin SVD. The
+    shrunk matrix is then U diag(ST(sig, eps) / sig) U^T X, so V is never
+    formed. Squaring X loses precision on singular values far below the
+    largest one, but those are the ones removed by the threshold.
+
+    parameters
+    ----------
+        X : npumpy.darray
+            first parameter, matrix to be thresholded
+        eps : double
+            second parameter, thershold
+        svd_method : str
+            third parameter, 'svd' or 'gram' (default = 'svd')
+        out : npumpy.darray | None
+            fourth parameter, C-contiguous array of the dtype of X the result
+            is written into (default = None, a new array)
+        return_rank : bool
+            fifth parameter, whether to also return the number of singular
+            values above eps (default = False)
+
+    return
+    ------
+        L : npumpy.darray
+            thersholded matrix, same shape as X
+        svp : int
+            only if return_rank is True, the rank of L
+    """
+    if svd_method == "gram":
+        w, U = _gram_eigh(X)
+        sig = np.sqrt(np.maximum(w, 0))
+        keep = sig > eps
+        U = U[:, keep]
+        scale = (soft_thres(sig[keep], eps) / sig[keep]).astype(X.dtype)
+        L = np.dot(U * scale, np.dot(U.T, X), out=out)
+    else:
+        U, sig, V = np.linalg.svd(X, full_matrices=False)
+        V *= soft_thres(sig, eps)[:, np.newaxis]
+        L = np.dot(U, V, out=out)
+    if return_rank:
+        return L, int(np.sum(sig > eps))
+    return L
+
+
+def randomized_svd_thres(X, eps, rank, random_state=None, n_iter=2, out=None):
+
+    """ Singular value thresholding of X using only its leading singular triplets
+
+    The range of X is estimated from rank + N_OVERSAMPLES random
+    projections refined by n_iter power iterations (Halko et al. 2011),
+    and only the singular values of X projected onto that range are
+    computed. If every computed singular value is above eps the range
+    was too small, so it is doubled until the threshold is reached or the
+    full rank of X is covered.
+
+    parameters
+    ----------
+        X : npumpy.darray
+            first parameter, matrix to be thresholded
+        eps : double
+            second parameter, thershold
+        rank : int
+            third parameter, predicted number of singular values above eps
+        random_state : np.random.RandomState | None
+            fourth parameter, source of the random projections
+        n_iter : int
+            fifth parameter, number of power iterations (default = 2)
+        out : npumpy.darray | None
+            sixth parameter, C-contiguous array of the dtype of X the result
+            is written into (default = None, a new array)
+
+    return
+    ------
+        L : npumpy.darray
+            thersholded matrix, same shape as X
+        svp : int
+            number of singular values above eps
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    n = min(X.shape)
+    n_components = rank + N_OVERSAMPLES
+    while n_components < n:
+        omega = random_state.randn(X.shape[1], n_components)
+        Q, _ = np.linalg.qr(np.dot(X, omega.astype(X.dtype, copy=False)))
+        for _ in range(n_iter):
+            # the intermediate X^T Q is not re-orthonormalized, which is
+            # enough for the few power iterations used here
+            Q, _ = np.linalg.qr(np.dot(X, np.dot(X.T, Q)))
+        # X ~ Q B, and the singular values of the small B come from the
+        # eigendecomposition of B B^T as in the 'gram' path of svd_thres
+        B = np.dot(Q.T, X)
+        w, U = _gram_eigh(B)
+        sig = np.sqrt(np.maximum(w, 0))
+        keep = sig > eps
+        svp = int(np.sum(keep))
+        if svp < n_components:
+            U = U[:, keep]
+            scale = (soft_thres(sig[keep], eps) / sig[keep]).astype(X.dtype)
+            return np.dot(np.dot(Q, U) * scale, np.dot(U.T, B), out=out), svp
+        n_components *= 2
+    U, sig, V = np.linalg.svd(X, full_matrices=False)
+    svp = int(np.sum(sig > eps))
+    scale = (sig[:svp] - eps).astype(X.dtype)
+    return np.dot(U[:, :svp] * scale, V[:svp], out=out), svp
+
+
+# RPCA solvers by name, all called as solver(M, lam=..., tol=..., maxIter=...,
+# svd_method=..., state=..., return_state=..., diagnostics=...,
+# stall_window=..., stall_rtol=..., **options) where options are specific
+# to each solver. New backends are added here
+SOLVERS = {"alm": rpca, "altproj": rpca_altproj}
+
+
+def get_solver(name):
+
+    """ RPCA solver registered under name in SOLVERS
+
+    parameters
+    ----------
+        name : str
+            first parameter, 'alm' (rpca, convex inexact ALM) or 'altproj'
+            (rpca_altproj, non-convex alternating projections)
+
+    return
+    ------
+        solver : function
+            the solver
+    """
+    if name not in SOLVERS:
+        raise ValueError("rpca solver must be one of " + ", ".join(sorted(SOLVERS)))
+    return SOLVERS[name]
@@ -8,8 +8,11 @@ import mne_bids
 from matplotlib import pyplot as plt
 from mne_bids.read import _read_raw, read_raw_bids
 from mne_bids.utils import _parse_bids_filename, _write_json
+from scipy import sparse
 
+from pyautomagic.preprocessing.cache import StageCache
 from pyautomagic.preprocessing.preprocess import Preprocess as execute_preprocess
+from pyautomagic.preprocessing.preprocess import stage_params
 from pyautomagic.src.calcQuality import calcQuality
 from pyautomagic.src.rateQuality import rateQuality
 
@@ -61,10 +64,16 @@ class Block:
         used to track how many changes were made to the evaluation of the data
     Methods
     -------
+    set_data_params(data)
+        set the parameters depending on the raw data
+    prepare_preprocess()
+        load the raw data and set up its preprocessing
     preprocess()
         run the block through preprocessing steps, calc quality scores, save files, write log
     interpolate()
         interpolate the dataset, update quality scores and rating, save files, write log
+    load_noise()
+        load the sparse RPCA noise saved by preprocess, if any
     """
 
     def __init__(self, root_path, data_filename, project, subject):
@@ -81,8 +90,8 @@ class Block:
         self.is_rated = False
         self.is_interpolated = False
         self.times_committed = -1
-        self.update_rating_from_file()
         self.rate = "not rated"
+        self.update_rating_from_file()
         self.index = -1
         # self.auto_bad_chans = []
 
@@ -91,7 +100,11 @@ class Block:
         Updates block information from the file currently stored
 
         Checks for results file, if it's there, and informaation, we update.
-        No direct returns, but updates block fields.
+        No direct returns, but updates block fields. The rating is only kept
+        if the stages of the preprocessing were performed with the same
+        parameters as this project would perform them, see
+        preprocessing.preprocess.stage_params (parameters which only affect
+        speed or memory, e.g. params['n_jobs'], may differ).
 
         Parameters
         ----------
@@ -105,13 +118,25 @@ class Block:
         result_filename = self.unique_name + "_results.json"
         result_file_overall = os.path.join(self.result_path, result_filename)
         if os.path.isfile(result_file_overall):
+            self.rate = "not rated"
+            self.to_be_interpolated = []
+            self.is_interpolated = False
+            self.auto_bad_chans = []
+            self.final_bad_chans = []
+            self.quality_scores = None
+            self.times_committed = int(0)
             with open(result_file_overall) as json_file:
                 block = json.load(json_file)
             saved_params = block["params"]
-            if not saved_params == self.params:
-                raise ValueError(
-                    "Parameters of results file do not match this project. Can not merge."
+            if not _same_stage_params(saved_params, self.params):
+                # the block is not rated, it is preprocessed again with the
+                # parameters of this project, see Project.preprocess_all
+                logger.log(
+                    20,
+                    "Parameters of results file of %s do not match this project.",
+                    self.unique_name,
                 )
+                return
             if block["is_interpolated"] or block["is_rated"]:
                 self.rate = block["rate"]
                 self.to_be_interpolated = block["to_be_interpolated"]
@@ -120,14 +145,8 @@ class Block:
                 self.final_bad_chans = block["final_bad_chans"]
                 self.quality_scores = block["quality_scores"]
                 self.times_committed = block["times_committed"]
-            else:
-                self.rate = "not rated"
-                self.to_be_interpolated = []
-                self.is_interpolated = False
-                self.auto_bad_chans = []
-                self.final_bad_chans = []
-                self.quality_scores = None
-                self.times_committed = int(0)
+                self.is_rated = block["is_rated"]
+                self.is_manually_rated = block.get("is_manually_rated", False)
 
     def find_result_path(self):
         """
@@ -160,26 +179,107 @@ class Block:
             )
         return result_path
 
-    def preprocess(self):
+    def set_data_params(self, data):
         """
-        Preprocesses the raw data associated with this block
+        Sets the parameters depending on the raw data (sample rate and
+        channels) in params['interpolation_params']. params['line_freqs'],
+        the line frequency removed if params['line_noise_method'] is
+        'interpolation', is kept
 
         Parameters
         ----------
-        none
+        data: mne.io.Raw
+            raw data of the block, e.g. from load_data
 
         Returns
         -------
-       results: dict
-            dictionary containing all the new updates to the block and the preprocessed array
+        none
 
         """
-        data = self.load_data()
-        self.params["line_freqs"] = data.info["sfreq"]
         self.params["interpolation_params"]["line_freqs"] = data.info["sfreq"]
         self.params["interpolation_params"]["ref_chs"] = data.ch_names
         self.params["interpolation_params"]["reref_chs"] = data.ch_names
-        preprocess = execute_preprocess(data, self.params)
+
+    def prepare_preprocess(self, data=None, stages=None):
+        """
+        Loads the raw data associated with this block and sets up its preprocessing
+
+        Parameters
+        ----------
+        data: mne.io.Raw | None
+            raw data of the block, loaded with load_data if None
+        stages: list of str | None
+            stages to perform (see preprocessing.preprocess.invalidated_stages),
+            the outputs of the others are restored from the results of the
+            last preprocessing where they are saved (the bad channels of
+            prep). All the stages if None
+
+        Returns
+        -------
+        preprocess: Preprocess
+            preprocessing of the raw data, not performed yet
+
+        """
+        if data is None:
+            data = self.load_data()
+        self.set_data_params(data)
+        stored_outputs = {}
+        result_file = os.path.join(self.result_path, self.unique_name + "_results.json")
+        if stages is not None and "prep" not in stages and os.path.isfile(result_file):
+            with open(result_file) as json_file:
+                results = json.load(json_file)
+            stored_outputs["prep"] = ({}, {"bads": results["auto_bad_chans"]})
+        # a long RPCA solve is checkpointed next to the results, so that a
+        # preempted job resumes it
+        os.makedirs(self.result_path, exist_ok=True)
+        checkpoint = os.path.join(
+            self.result_path, self.unique_name + "_rpca_checkpoint"
+        )
+        # filter kernels are designed once for the whole project, also across
+        # worker processes
+        filter_cache_dir = os.path.join(self.project.results_folder, "filter_kernels")
+        # the EOG regression coefficients of the first run of the subject (or
+        # session) are reused by its other runs
+        eog_coef_file = None
+        if self.params.get("eog_coef_reuse", False):
+            eog_coef_file = os.path.join(self.result_path, "eog_coefficients.npz")
+        # the outputs of the stages are cached for the whole project, so
+        # that changing a parameter only performs the stages depending on it
+        stage_cache = None
+        if self.params.get("stage_cache", False):
+            stage_cache = StageCache(
+                os.path.join(self.project.results_folder, "stage_cache"),
+                self.params.get("stage_cache_size", 2 ** 34),
+            )
+        return execute_preprocess(
+            data,
+            self.params,
+            checkpoint=checkpoint,
+            eog_coef_file=eog_coef_file,
+            stage_cache=stage_cache,
+            filter_cache_dir=filter_cache_dir,
+            stored_outputs=stored_outputs,
+        )
+
+    def preprocess(self, preprocess=None):
+        """
+        Preprocesses the raw data associated with this block
+
+        Parameters
+        ----------
+        preprocess: Preprocess
+            preprocessing returned by prepare_preprocess, with some of its
+            steps possibly performed already (e.g. RPCA batched with other
+            blocks). Default is a new one
+
+        Returns
+        -------
+       results: dict
+            dictionary containing all the new updates to the block and the preprocessed array
+
+        """
+        if preprocess is None:
+            preprocess = self.prepare_preprocess()
         preprocessed, fig_1, fig_2 = preprocess.fit()
         overall_thresh = self.project.quality_thresholds["overall_thresh"]
         time_thresh = self.project.quality_thresholds["time_thresh"]
@@ -222,7 +322,11 @@ class Block:
                 "is_rated": self.is_rated,
             }
         )
-        results = {"preprocessed": preprocessed, "automagic": automagic}
+        results = {
+            "preprocessed": preprocessed,
+            "automagic": automagic,
+            "noise": preprocess.noise,
+        }
         self.save_all_files(results, fig_1, fig_2)
         self.write_log(automagic)
         return results
@@ -343,6 +447,12 @@ class Block:
         processed_filename = self.unique_name + "_raw.fif"
         processed_file_overall = os.path.join(self.result_path, processed_filename)
         processed.save(processed_file_overall, overwrite=True)
+        # only sparse noise is archived, a dense copy would double the
+        # size of the derivatives
+        if sparse.issparse(results.get("noise")):
+            noise_filename = self.unique_name + "_noise.npz"
+            noise_file_overall = os.path.join(self.result_path, noise_filename)
+            sparse.save_npz(noise_file_overall, results["noise"], compressed=True)
 
         plt.figure(fig1.number)
         fig1_name = self.unique_name + ".png"
@@ -353,6 +463,30 @@ class Block:
         fig2_name_overall = os.path.join(self.result_path, fig2_name)
         plt.savefig(fig2_name_overall, dpi=100)
 
+    def load_noise(self, dense=False):
+        """
+        Load the RPCA noise saved next to the preprocessed data
+
+        Only saved when preprocessed with params['sparse_noise']
+
+        Parameters
+        ----------
+        dense: bool
+            if True, return it as a numpy array instead of a sparse matrix
+
+        Returns
+        -------
+        noise: scipy.sparse.csr_matrix | numpy.ndarray | None
+            channels x samples noise removed by RPCA, None if it was not saved
+
+        """
+        noise_filename = self.unique_name + "_noise.npz"
+        noise_file_overall = os.path.join(self.result_path, noise_filename)
+        if not os.path.isfile(noise_file_overall):
+            return None
+        noise = sparse.load_npz(noise_file_overall)
+        return noise.toarray() if dense else noise
+
     def write_log(self, updates):
         """
         Writes a log for all of the updates its making/actions performed
@@ -383,6 +517,14 @@ class Block:
             )
         if "eog_regression" in updates and updates["eog_regression"]["performed"]:
             logger.log(20, "EOG regression performed.")
+        if "perform_RPCA" in updates and updates["perform_RPCA"]["performed"]:
+            logger.log(
+                20,
+                f'RPCA performed in {sum(updates["perform_RPCA"]["n_iter"])} iterations.',
+            )
+            stop_reasons = updates["perform_RPCA"]["stop_reason"]
+            if any(reason != "converged" for reason in stop_reasons):
+                logger.log(30, f"RPCA did not converge: {stop_reasons}")
         logger.log(20, "Remove DC offset by subtracting the channel mean")
         if (
             "high_var_rejection" in updates
@@ -491,3 +633,36 @@ class Block:
         processed_file_overall = os.path.join(self.result_path, processed_filename)
         processed.save(processed_file_overall, overwrite=True)
         return results
+
+
+def _same_stage_params(saved_params, params):
+    """
+    Whether the stages of Preprocess performed with saved_params are performed
+    the same with params. The parameters Block.set_data_params sets from the
+    raw data are taken from saved_params, since they are not set in params
+    until the data is loaded
+
+    Parameters
+    ----------
+    saved_params: dict
+        parameters saved in the results file of a block
+    params: dict
+        parameters of the project
+
+    Returns
+    -------
+    bool
+        whether their stage_params are equal
+
+    """
+    saved_data_params = {
+        key: saved_params.get("interpolation_params", {}).get(key)
+        for key in ("line_freqs", "ref_chs", "reref_chs")
+    }
+    params = dict(
+        params,
+        interpolation_params=dict(
+            params.get("interpolation_params", {}), **saved_data_params
+        ),
+    )
+    return stage_params(saved_params) == stage_params(params)
@@ -1,10 +1,17 @@
 import numpy as np
 import timeit
+import json
 import os
 import logging
 import mne
 import mne_bids
 from mne_bids.utils import _write_json
+from pyautomagic.preprocessing.preprocess import (
+    invalidated_stages,
+    perform_RPCA_batch,
+    source_files,
+    stage_params,
+)
 from pyautomagic.src.rateQuality import rateQuality
 from pyautomagic.src.Block import Block
 from pyautomagic.src.Subject import Subject
@@ -64,6 +71,10 @@ class Project:
     CGV : dict
         Constant Global Variables
 
+    stage_params : dict
+        parameters the stages of every block were last performed with (see
+        preprocessing.preprocess.stage_params), by block
+
     """
 
     def __init__(self, name, d_folder, file_ext, montage, sampling_rate, params):
@@ -85,6 +96,7 @@ class Project:
         self.automagic_final = {}
         self.montage = montage
         self.sampling_rate = sampling_rate
+        self.stage_params = self.load_stage_params()
 
         # Calling create_rating_structures() method
         self.create_ratings_structure()
@@ -118,6 +130,15 @@ class Project:
         """
         Preprocess all files in the data folder of the project
 
+        Only the stages of Preprocess whose parameters changed since a block
+        was last preprocessed (or all of them if its raw file changed), and
+        the stages downstream of them, are invalidated, which is decided from
+        the header of the raw file before its data is loaded. A block with no
+        invalidated stage is skipped. For the others, the outputs of the
+        stages not invalidated are restored instead of performed, from the
+        results of the block (the bad channels of prep) and, with
+        params['stage_cache'], from the cache.
+
         Parameters
         ----------
         None
@@ -136,6 +157,12 @@ class Project:
         else:
             logging.log(20, "----- START PREPROCESSING -----")
             start_time = timeit.default_timer()  # Calculates start time
+            # with params['rpca_batch_size'], blocks are preprocessed up to
+            # RPCA and grouped by shape, and the RPCA of every group of that
+            # many blocks is solved at once
+            batch_size = self.params.get("rpca_batch_size")
+            groups = {}
+            pending = {}
             for i in range(0, len(self.block_list)):
                 unique_name = self.block_list[i]
                 block = self.block_map[unique_name]
@@ -155,17 +182,52 @@ class Project:
                         os.path.join(self.results_folder, "sub-" + subject_name)
                     )
 
-                p_results = block.preprocess()  # Preprocess function
-                EEG = p_results["preprocessed"]
-                if not EEG:
-                    logging.log(40, "EEG PREPROCESSED DATA NOT FOUND")
-                    break
-
-                if self.current == -1:
-                    self.current = 1
-
-                self.update_project(p_results)  # Function to save the current changes
-                logging.log(20, "**Project saved**")
+                # only the header is read until the block is preprocessed
+                data = block.load_data()
+                block.set_data_params(data)
+                source = source_files(data)
+                last_params = None
+                if os.path.isfile(
+                    os.path.join(block.result_path, block.unique_name + "_results.json")
+                ):
+                    last_params = self.stage_params.get(block.unique_name)
+                stages = invalidated_stages(last_params, self.params, source)
+                if not stages:
+                    logging.log(
+                        20, "Parameters unchanged, skipping %s", block.unique_name
+                    )
+                    continue
+                logging.log(20, "Invalidated stages: %s", ", ".join(stages))
+                # the parameters are recorded once the block is preprocessed
+                pending[block.unique_name] = stage_params(self.params, source)
+                preprocess = block.prepare_preprocess(data, stages)
+
+                if not batch_size:
+                    if not self.preprocess_block(block, preprocess):
+                        break
+                    self.record_stage_params(
+                        block.unique_name, pending.pop(block.unique_name)
+                    )
+                    continue
+                shape = preprocess.prepare_RPCA()._data.shape
+                groups.setdefault(shape, []).append((block, preprocess))
+                if len(groups[shape]) == batch_size:
+                    group = groups.pop(shape)
+                    if not self.preprocess_batch(group):
+                        break
+                    for block, _ in group:
+                        self.record_stage_params(
+                            block.unique_name, pending.pop(block.unique_name)
+                        )
+            else:
+                # the groups left are smaller than batch_size
+                for group in groups.values():
+                    if not self.preprocess_batch(group):
+                        break
+                    for block, _ in group:
+                        self.record_stage_params(
+                            block.unique_name, pending.pop(block.unique_name)
+                        )
             self.save_project()  # Function to save all the changes
             end_time = timeit.default_timer()  # End time
             logging.log(20, "---- PREPROCESSING FINISHED ----")
@@ -173,6 +235,62 @@ class Project:
                 20, "Total elapsed time: %s sec", end_time - start_time
             )  # Prints total elapsed time of the process
 
+    def preprocess_block(self, block, preprocess=None):
+        """
+        Preprocesses a block and saves the project
+
+        Parameters
+        ----------
+        block : Block
+            Block to preprocess
+        preprocess : Preprocess
+            Preprocessing of the block, possibly partly performed, see
+            Block.preprocess
+
+        Returns
+        -------
+        bool
+            False if the preprocessed data was not found
+
+        """
+
+        p_results = block.preprocess(preprocess)  # Preprocess function
+        EEG = p_results["preprocessed"]
+        if not EEG:
+            logging.log(40, "EEG PREPROCESSED DATA NOT FOUND")
+            return False
+
+        if self.current == -1:
+            self.current = 1
+
+        self.update_project(p_results)  # Function to save the current changes
+        logging.log(20, "**Project saved**")
+        return True
+
+    def preprocess_batch(self, group):
+        """
+        Solves the RPCA of a group of same-shape blocks at once, then finishes
+        preprocessing each of them
+
+        Parameters
+        ----------
+        group : list of (Block, Preprocess)
+            Blocks with their preprocessing performed up to RPCA
+
+        Returns
+        -------
+        bool
+            False if the preprocessed data of a block was not found
+
+        """
+
+        logging.log(20, "Solving RPCA of %s blocks at once", len(group))
+        perform_RPCA_batch([preprocess for _, preprocess in group])
+        for block, preprocess in group:
+            if not self.preprocess_block(block, preprocess):
+                return False
+        return True
+
     def interpolate_selected(self):
         """
         Interpolates all the channels selected to be interpolated
@@ -369,6 +487,70 @@ class Project:
         _write_json(
             result_file_path, self.automagic_final, overwrite=True, verbose=True
         )
+        self.save_stage_params()
+
+    def record_stage_params(self, block_name, block_stage_params):
+        """
+        Records the parameters the stages of a block were performed with and
+        saves them right away, so that if preprocess_all is interrupted, the
+        blocks it finished are not preprocessed again
+
+        Parameters
+        ----------
+        block_name : str
+            unique name of the block
+        block_stage_params : dict
+            parameters of its stages (see preprocessing.preprocess.stage_params)
+
+        Returns
+        -------
+        None
+
+        """
+        self.stage_params[block_name] = block_stage_params
+        self.save_stage_params()
+
+    def save_stage_params(self):
+        """
+        saves the parameters the stages of every block were last performed
+        with to a JSON file
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        stage_params_file = self.name + "_stage_params.json"
+        stage_params_file_path = os.path.join(self.results_folder, stage_params_file)
+        _write_json(
+            stage_params_file_path, self.stage_params, overwrite=True, verbose=True
+        )
+
+    def load_stage_params(self):
+        """
+        Loads the parameters the stages of every block were last performed
+        with, saved by save_stage_params
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        stage_params : dict
+            parameters of the stages by block, empty if none were saved
+
+        """
+        stage_params_file = self.name + "_stage_params.json"
+        stage_params_file_path = os.path.join(self.results_folder, stage_params_file)
+        if not os.path.isfile(stage_params_file_path):
+            return {}
+        with open(stage_params_file_path) as json_file:
+            return json.load(json_file)
 
     def update_project(self, preprocessed):
         """
@@ -100,7 +100,7 @@ def calcQuality(
     std_across_time = np.std(data, axis=1)
     chan_high_var = np.sum(std_across_time > chanThresh) / n_chans
     # unthresholded mean absolute voltage
-    mean_abs_volt = np.mean(np.absolute(data))
+    mean_abs_volt = np.mean(np.absolute(data), dtype=np.float64)
 
     quality_metrics = {
         "overall_high_amp": overall_high_amp,
@@ -37,7 +37,7 @@ URL = 'https://github.com/NeuroDataDesign/pyautomagic'
 MINIMUM_PYTHON_VERSION = 3, 6  # Minimum of Python 3.6
 REQUIRED_PACKAGES = [
     "numpy>=1.14.5",
-    "scipy>=1.1.0",
+    "scipy>=1.4.0",
     "scikit-learn>=0.19.2",
     "pandas>=0.23.4",
     "mne>=0.19.2",
@@ -1,7 +1,11 @@
 import numpy as np
 import pytest
 
-from pyautomagic.preprocessing.perform_EOG_regression import perform_EOG_regression
+from pyautomagic.preprocessing.perform_EOG_regression import (
+    EOG_regression_coefficients,
+    apply_EOG_regression,
+    perform_EOG_regression,
+)
 
 
 def test_EOG_egression():
@@ -18,3 +22,43 @@ def test_EOG_egression():
     assert np.sqrt(np.mean((clean - pure) ** 2)) < 0.1
 
 
+def test_EOG_regression_pinv():
+    """Test that the streamed regression matches the pseudoinverse one"""
+
+    np.random.seed(0)
+    eog = np.random.normal(0, 1, (3, 1000))
+    eeg = np.random.normal(0, 1, (8, 1000)) + np.dot(np.random.normal(0, 1, (8, 3)), eog)
+    expected = eeg - np.dot(np.dot(eeg, eog.T), np.dot(np.linalg.pinv(np.dot(eog, eog.T)), eog))
+    clean = perform_EOG_regression(eeg, eog, chunk_size=128)
+    assert np.allclose(clean, expected)
+    # rank deficient EOG gets the minimum norm solution, as with pinv
+    eog[2] = eog[0] + eog[1]
+    expected = eeg - np.dot(np.dot(eeg, eog.T), np.dot(np.linalg.pinv(np.dot(eog, eog.T)), eog))
+    assert np.allclose(perform_EOG_regression(eeg, eog, chunk_size=128), expected)
+
+
+def test_EOG_regression_memmap(tmp_path):
+    """Test the regression of memory-mapped data, without changing the inputs"""
+
+    np.random.seed(0)
+    eog = np.random.normal(0, 1, (2, 5000))
+    eeg = np.random.normal(0, 1, (4, 5000)) + np.dot(np.random.normal(0, 1, (4, 2)), eog)
+    eeg_mm = np.memmap(tmp_path / "eeg.dat", np.float64, "w+", shape=eeg.shape)
+    eog_mm = np.memmap(tmp_path / "eog.dat", np.float64, "w+", shape=eog.shape)
+    eeg_mm[:] = eeg
+    eog_mm[:] = eog
+    out = np.memmap(tmp_path / "clean.dat", np.float64, "w+", shape=eeg.shape)
+    clean = perform_EOG_regression(eeg_mm, eog_mm, chunk_size=1000, out=out)
+    assert clean is out
+    assert np.allclose(clean, perform_EOG_regression(eeg, eog))
+    assert np.array_equal(eeg_mm, eeg) and np.array_equal(eog_mm, eog)
+    coef = EOG_regression_coefficients(eeg_mm, eog_mm, chunk_size=1000)
+    assert coef.shape == (2, 4)
+    assert np.allclose(apply_EOG_regression(eeg, eog, coef), clean)
+    # 1-D inputs are not resized in place
+    signal = eeg[0].copy()
+    noise = eog[0].copy()
+    assert perform_EOG_regression(signal, noise).shape == (1, 5000)
+    assert signal.shape == (5000,) and noise.shape == (5000,)
+    with pytest.raises(ValueError):
+        perform_EOG_regression(eeg, eog[:, :-1])
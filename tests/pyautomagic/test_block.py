@@ -95,6 +95,47 @@ def test_existing_results_file():
     assert test_block.times_committed == 0
 
 
+def test_rating_with_other_params(tmp_path):
+    sub_name = "18"
+    dummy_subject = Subject.Subject(sub_name)
+    data_filename = "sub-18_task-rest_eeg.set"
+    result_path = os.path.join(str(tmp_path), "derivatives", "automagic", "sub-18")
+    os.makedirs(result_path)
+    results = {
+        "rate": "Good",
+        "is_rated": True,
+        "is_manually_rated": True,
+        "is_interpolated": False,
+        "to_be_interpolated": [],
+        "auto_bad_chans": ["E1"],
+        "final_bad_chans": [],
+        "quality_scores": {"overall_high_amp": 0.05},
+        "times_committed": 2,
+    }
+    result_file = os.path.join(result_path, "sub-18_task-rest_eeg_results.json")
+    # the parameters which only affect speed or memory, or are set from the
+    # data, do not change the rating
+    saved_params = dict(
+        params,
+        n_jobs=4,
+        filter_n_jobs=2,
+        low_memory=True,
+        interpolation_params=dict(params["interpolation_params"], ref_chs=["E1"]),
+    )
+    with open(result_file, "w") as json_file:
+        json.dump(dict(results, params=saved_params), json_file)
+    test_block = Block.Block(str(tmp_path), data_filename, dummy_project, dummy_subject)
+    assert test_block.rate == "Good"
+    assert test_block.is_manually_rated
+    assert test_block.times_committed == 2
+    # the ones of the stages do
+    with open(result_file, "w") as json_file:
+        json.dump(dict(results, params=dict(params, lam=0.1)), json_file)
+    test_block = Block.Block(str(tmp_path), data_filename, dummy_project, dummy_subject)
+    assert test_block.rate == "not rated"
+    assert test_block.times_committed == 0
+
+
 def test_preprocess_and_interpolate():
     sub_name = "18"
     dummy_subject = Subject.Subject(sub_name)
@@ -134,3 +175,25 @@ def test_preprocess_and_interpolate():
         os.path.join(".", "tests", "test_data", "test_project", "derivatives", "automagic", "sub-18", "sub-18_task-rest_eeg_orig.png")
     )
     # os.path.remove('./tests/test_data/test_project/derivatives/automagic/sub-18/sub-18_task-rest_eeg_raw.fif')
+
+
+def test_line_noise_interpolation():
+    line_noise_params = dict(
+        params,
+        line_noise_method="interpolation",
+        line_freqs=60,
+        interpolation_params=dict(params["interpolation_params"]),
+    )
+    project = Project.Project(
+        name, root_path, file_ext, montage, sampling_rate, line_noise_params
+    )
+    dummy_subject = Subject.Subject("18")
+    data_filename = "sub-18_task-rest_eeg.set"
+    test_block = Block.Block(root_path, data_filename, project, dummy_subject)
+    data = test_block.load_data()
+    test_block.set_data_params(data)
+    # the line frequency is not replaced by the sample rate
+    assert test_block.params["line_freqs"] == 60
+    assert test_block.params["interpolation_params"]["line_freqs"] == data.info["sfreq"]
+    preprocess = test_block.prepare_preprocess(data)
+    assert preprocess.params["line_freqs"] == 60
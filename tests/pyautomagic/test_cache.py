@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+import pytest
+
+from pyautomagic.preprocessing.cache import StageCache
+
+
+def test_get_put(tmp_path):
+    cache = StageCache(str(tmp_path))
+    key = StageCache.key("load", np.arange(3), {"lam": -1})
+    assert key == StageCache.key("load", np.arange(3), {"lam": -1})
+    assert key != StageCache.key("load", np.arange(3), {"lam": 0.1})
+    assert key != StageCache.key("load", np.arange(3.0), {"lam": -1})
+    assert cache.get(key) == (None, None)
+    data = np.random.RandomState(0).randn(4, 100)
+    cache.put(key, {"data": data}, {"sfreq": np.float64(160), "bads": ["Fz"]})
+    arrays, metadata = cache.get(key)
+    assert isinstance(arrays["data"], np.memmap)
+    assert np.array_equal(arrays["data"], data)
+    assert metadata == {"sfreq": 160.0, "bads": ["Fz"]}
+    # in place changes of a loaded output do not change the cache
+    arrays["data"][:] = 0
+    assert np.array_equal(cache.get(key)[0]["data"], data)
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith(".tmp")]
+
+
+def test_evict(tmp_path):
+    cache = StageCache(str(tmp_path))
+    data = np.zeros(1000)
+    for key in ["a", "b", "c"]:
+        cache.put(key, {"data": data}, {})
+        # modification times of a fast filesystem may be equal
+        os.utime(os.path.join(str(tmp_path), key, "metadata.json"),
+                 (len(os.listdir(str(tmp_path))),) * 2)
+    size = cache.size() // 3
+    cache.get("a")
+    # the least recently used output, b, is evicted first
+    cache.max_size = 2 * size
+    cache.evict()
+    assert cache.get("b") == (None, None)
+    assert cache.get("a")[0] is not None and cache.get("c")[0] is not None
+    cache.clear()
+    assert cache.size() == 0
@@ -1,5 +1,7 @@
+import mne
 import numpy as np
 import pytest
+from scipy import signal
 
 from pyautomagic.preprocessing import performFilter
 
@@ -44,3 +46,186 @@ def test_lack_filter_input():
     input_signal = np.random.normal(0.5, size=np.size(times))
     assert np.array_equal(performFilter.performFilter(input_signal, sfreq), input_signal)
 
+
+def test_kernel_cache(tmp_path):
+    """
+    Cached kernels filter exactly as mne does, are designed once per process and
+    are shared through the on-disk cache
+
+    """
+    times = np.arange(0, 20, .001)
+    sfreq = 1000
+    input_signal = np.random.normal(0.5, size=(4, np.size(times)))
+    performFilter.clear_kernel_cache()
+    output = performFilter.performFilter(input_signal, sfreq, 'high', 1, cache_dir=str(tmp_path))
+    expected = mne.filter.filter_data(input_signal, sfreq, 1, None, fir_design='firwin',
+                                      pad='reflect_limited', verbose=False)
+    assert np.allclose(output, expected, rtol=0, atol=1e-12)
+    output = performFilter.performFilter(input_signal, sfreq, 'notch', 60)
+    expected = mne.filter.notch_filter(input_signal, sfreq, 60, trans_bandwidth=1, fir_design='firwin',
+                                       pad='reflect_limited', verbose=False)
+    assert np.allclose(output, expected, rtol=0, atol=1e-12)
+
+    h = performFilter.get_kernel(sfreq, 'high', 1)
+    assert performFilter.get_kernel(sfreq, 'high', 1.0) is h
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+    # a new process finds the kernel on disk
+    performFilter.clear_kernel_cache()
+    assert np.array_equal(performFilter.get_kernel(sfreq, 'high', 1, cache_dir=str(tmp_path)), h)
+
+
+def test_n_jobs():
+    """
+    Filtering groups of channels in threads gives the single threaded result
+
+    """
+    times = np.arange(0, 5, .001)
+    sfreq = 1000
+    input_signal = np.random.normal(0.5, size=(2, 5, np.size(times)))
+    expected = performFilter.performFilter(input_signal, sfreq, 'low', 30)
+    for n_jobs in (3, -1, 20):
+        output = performFilter.performFilter(input_signal, sfreq, 'low', 30, n_jobs=n_jobs)
+        assert output.shape == input_signal.shape
+        assert np.array_equal(output, expected)
+
+
+def test_composite_filter():
+    """
+    A list of filters is applied in a single pass, with the result of applying them one after the other
+
+    """
+    times = np.arange(0, 20, .001)
+    sfreq = 1000
+    low_freq_signal = 5*np.sin(2*np.pi*10*times)
+    high_freq_signal = np.cos(2*np.pi*80*times)
+    power_freq_noise = 2*np.sin(2*np.pi*60*times)
+    drift = 3*np.sin(2*np.pi*0.05*times)
+    input_signal = low_freq_signal + high_freq_signal + power_freq_noise + drift
+
+    output = performFilter.performFilter(input_signal, sfreq, ['high', 'low', 'notch'], [1, 40, None])
+    expected = performFilter.performFilter(
+        performFilter.performFilter(performFilter.performFilter(input_signal, sfreq, 'high', 1), sfreq, 'low', 40),
+        sfreq, 'notch', 60)
+    assert np.allclose(output, expected, rtol=0, atol=1e-10)
+    # only the 10Hz sinusoid signal is kept
+    error = (output - low_freq_signal)[2000:-2000]
+    assert (np.sqrt(np.mean(error**2)) < 0.1)
+    assert performFilter.performFilter(input_signal, sfreq, ['high', 'band'], [1, 70]) is None
+
+
+def test_iir():
+    """
+    IIR filters keep and remove the same frequencies as the FIR filters, and can be mixed with them
+
+    """
+    times = np.arange(0, 20, .001)
+    sfreq = 1000
+    low_freq_signal = 5*np.sin(2*np.pi*10*times)
+    high_freq_signal = np.cos(2*np.pi*80*times)
+    power_freq_noise = 2*np.sin(2*np.pi*60*times)
+    input_signal = low_freq_signal + high_freq_signal + power_freq_noise
+
+    output_lowpass_filt = performFilter.performFilter(input_signal, sfreq, 'low', 30, method='iir')
+    output_highpass_filt = performFilter.performFilter(input_signal, sfreq, 'high', 30, method='iir')
+    output_notch_filt = performFilter.performFilter(input_signal, sfreq, 'notch', 60, method='iir')
+    assert (np.sqrt(np.mean((output_lowpass_filt - low_freq_signal)**2)) < 0.1)
+    assert (np.sqrt(np.mean((output_highpass_filt - high_freq_signal - power_freq_noise)**2)) < 0.1)
+    assert (np.sqrt(np.mean((output_notch_filt - high_freq_signal - low_freq_signal)**2)) < 0.1)
+
+    output = performFilter.performFilter(input_signal, sfreq, ['low', 'notch'], [40, 60], method=['fir', 'iir'])
+    error = (output - low_freq_signal)[2000:-2000]
+    assert (np.sqrt(np.mean(error**2)) < 0.1)
+    assert performFilter.performFilter(input_signal, sfreq, 'low', 30, method='fft') is None
+    # the 6dB frequency of the IIR filter is the one of the FIR filter
+    sos, _ = performFilter.get_sos(sfreq, 'high', 1)
+    _, response = signal.sosfreqz(sos, worN=[0.5], fs=sfreq)
+    assert np.isclose(np.abs(response[0])**2, 0.5)
+
+
+def test_streaming_filter(tmp_path):
+    """
+    Filtering a memory-mapped recording chunk by chunk gives the output of filtering it at once
+
+    """
+    sfreq = 500
+    input_signal = np.lib.format.open_memmap(str(tmp_path / 'eeg.npy'), mode='w+', shape=(3, 20000))
+    input_signal[:] = np.random.normal(0.5, size=(3, 20000))
+    expected = performFilter.performFilter(input_signal, sfreq, ['high', 'notch'], [0.5, 50])
+    for chunk_size in (1000, 4999):
+        stream = performFilter.StreamingFilter(sfreq, ['high', 'notch'], [0.5, 50])
+        output = [stream.push(input_signal[:, i:i + chunk_size]) for i in range(0, 20000, chunk_size)]
+        # nothing is returned before a kernel length of samples was pushed
+        assert output[0].shape == (3, 0)
+        output = np.concatenate(output + [stream.finish()], axis=-1)
+        assert np.allclose(output, expected, rtol=0, atol=1e-12)
+    # recordings shorter than the kernel are filtered in finish
+    stream = performFilter.StreamingFilter(sfreq, 'high', 0.5)
+    assert stream.push(input_signal[:, :100]).shape == (3, 0)
+    assert np.allclose(stream.finish(), performFilter.performFilter(input_signal[:, :100], sfreq, 'high', 0.5))
+    # nothing pushed: nothing to flush
+    assert performFilter.StreamingFilter(sfreq, 'high', 0.5).finish().shape == (0,)
+    # only empty chunks pushed: an empty output with their shape and dtype
+    stream = performFilter.StreamingFilter(sfreq, 'high', 0.5)
+    assert stream.push(np.empty((3, 0), np.float32)).shape == (3, 0)
+    output = stream.finish()
+    assert output.shape == (3, 0) and output.dtype == np.float32
+    with pytest.raises(ValueError):
+        performFilter.StreamingFilter(sfreq, 'band', 0.5)
+
+
+def test_interpolate_line_noise():
+    """
+    Spectrum interpolation removes the line noise and all its harmonics, and leaves the rest of the signal
+
+    """
+    times = np.arange(0, 20, .001)
+    sfreq = 1000
+    signal_ = 5*np.sin(2*np.pi*10*times) + np.cos(2*np.pi*80*times) + np.random.normal(0, 0.3, size=(4, np.size(times)))
+    line_noise = 2*np.sin(2*np.pi*60*times) + np.sin(2*np.pi*120*times + 1) + 0.5*np.sin(2*np.pi*420*times)
+    output = performFilter.interpolate_line_noise(signal_ + line_noise, sfreq, 60)
+    assert output.shape == signal_.shape
+    assert (np.sqrt(np.mean((output - signal_)**2)) < 0.05)
+    # no harmonic below the Nyquist frequency: nothing to remove
+    assert np.array_equal(performFilter.interpolate_line_noise(signal_, sfreq, sfreq), signal_)
+
+
+def test_multirate_highpass():
+    """
+    The multirate high-pass removes the trend as the FIR high-pass does, and is only available for high-pass filters
+
+    """
+    sfreq = 1000
+    times = np.arange(0, 120, .001)
+    drift = 0.05*np.cumsum(np.random.normal(size=(2, np.size(times))), axis=-1)
+    input_signal = drift + np.sin(2*np.pi*10*times)
+    expected = performFilter.performFilter(input_signal, sfreq, 'high', 0.5)
+    output = performFilter.performFilter(input_signal, sfreq, 'high', 0.5, method='multirate')
+    assert np.sqrt(np.mean((output - expected)**2) / np.mean(expected**2)) < 0.01
+    output = performFilter.performFilter(input_signal, sfreq, ['high', 'low'], [0.5, 30], method=['multirate', 'fir'])
+    expected = performFilter.performFilter(input_signal, sfreq, ['high', 'low'], [0.5, 30])
+    assert np.sqrt(np.mean((output - expected)**2) / np.mean(expected**2)) < 0.01
+    # shorter than the FIR filter: filtered with it
+    assert np.allclose(performFilter.performFilter(input_signal[:, :1000], sfreq, 'high', 0.5, method='multirate'),
+                       performFilter.performFilter(input_signal[:, :1000], sfreq, 'high', 0.5))
+    assert performFilter.performFilter(input_signal, sfreq, 'low', 30, method='multirate') is None
+
+
+def test_resample():
+    """
+    Resampling removes the frequencies above the new Nyquist frequency and keeps the others
+
+    """
+    times = np.arange(0, 20, .0005)
+    sfreq = 2000
+    low_freq_signal = 5*np.sin(2*np.pi*10*times)
+    alias = np.sin(2*np.pi*300*times)
+    output = performFilter.performFilter(low_freq_signal + alias, sfreq, None, None, resample_sfreq=250)
+    assert output.shape == (5000,)
+    assert (np.sqrt(np.mean((output - low_freq_signal[::8])**2)) < 0.01)
+    # not a view of the full rate filter output
+    assert output.base is None and output.flags.c_contiguous
+    # fused with the other filters, and non integer ratio
+    output = performFilter.performFilter(low_freq_signal + alias, sfreq, 'high', 1, resample_sfreq=300)
+    assert output.shape == (6000,)
+    assert (np.sqrt(np.mean((output - np.sin(2*np.pi*10*np.arange(0, 20, 1 / 300)) * 5)[300:-300]**2)) < 0.05)
+    assert performFilter.performFilter(low_freq_signal, sfreq, None, None, resample_sfreq=4000) is None
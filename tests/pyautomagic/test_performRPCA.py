@@ -1,7 +1,21 @@
+import tracemalloc
+
 import numpy as np
 import pytest
 
-from pyautomagic.preprocessing.rpca import rpca
+from pyautomagic.preprocessing.rpca import (
+    RPCADiagnostics,
+    column_leverage,
+    get_solver,
+    hard_thres,
+    randomized_svd_thres,
+    rpca,
+    rpca_altproj,
+    rpca_batch,
+    rpca_windowed,
+    soft_thres,
+    svd_thres,
+)
 
 
 def test_basic_input1():
@@ -96,3 +110,343 @@ def test_params3():
     assert(np.allclose(E,expected_E))
     print('test_params3 Pass')
 
+
+def test_gram_matches_svd():
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(8,2),np.random.randn(2,400))
+    sparse = np.random.randn(8,400)*(np.random.rand(8,400) < 0.05)*10
+    EEG = low_rank + sparse
+    A_svd,E_svd = rpca(EEG,svd_method='svd')
+    A_gram,E_gram = rpca(EEG,svd_method='gram')
+    assert(np.allclose(A_svd,A_gram))
+    assert(np.allclose(E_svd,E_gram))
+    A_auto,E_auto = rpca(EEG)
+    assert(np.array_equal(A_auto,A_gram))
+    print('test_gram_matches_svd Pass')
+
+def test_float32():
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(8,2),np.random.randn(2,400))
+    sparse = np.random.randn(8,400)*(np.random.rand(8,400) < 0.05)*10
+    EEG = low_rank + sparse
+    A,E = rpca(EEG)
+    for svd_method in ['svd','gram','randomized']:
+        diagnostics = RPCADiagnostics()
+        A32,E32 = rpca(EEG.astype(np.float32),svd_method=svd_method,
+                       diagnostics=diagnostics)
+        assert(A32.dtype == np.float32 and E32.dtype == np.float32)
+        assert(diagnostics.stop_reason == 'converged')
+        assert(np.allclose(A32,A,atol=1e-4))
+        assert(np.allclose(E32,E,atol=1e-4))
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(30,2),np.random.randn(2,600))
+    sparse = np.random.randn(30,600)*(np.random.rand(30,600) < 0.05)*10
+    EEG = low_rank + sparse
+    A32,E32 = rpca_altproj(EEG.astype(np.float32),rank=2)
+    assert(A32.dtype == np.float32)
+    assert(np.allclose(A32,low_rank,atol=1e-3))
+    print('test_float32 Pass')
+
+def test_incorrect_svd_method():
+    with pytest.raises(ValueError):
+        A,E = rpca(np.array([[1,2],[3,4]]),svd_method='qr')
+    print('test_incorrect_svd_method Pass')
+
+def test_randomized_matches_svd():
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(40,3),np.random.randn(3,400))
+    sparse = np.random.randn(40,400)*(np.random.rand(40,400) < 0.05)*10
+    EEG = low_rank + sparse
+    A_svd,E_svd = rpca(EEG,svd_method='svd')
+    A_rand,E_rand = rpca(EEG,svd_method='randomized')
+    assert(np.allclose(A_svd,A_rand,atol=1e-4))
+    assert(np.allclose(E_svd,E_rand,atol=1e-4))
+    print('test_randomized_matches_svd Pass')
+
+def test_randomized_rank_growth():
+    np.random.seed(0)
+    X = np.dot(np.random.randn(50,8),np.random.randn(8,300))
+    eps = np.linalg.svd(X,compute_uv=False)[7]/2
+    # predicted rank 1 is too low, the range must grow to find all 8
+    L,svp = randomized_svd_thres(X,eps,1,np.random.RandomState(0))
+    assert(svp == 8)
+    assert(np.allclose(L,svd_thres(X,eps)))
+    print('test_randomized_rank_growth Pass')
+
+def test_windowed_single_window():
+    EEG = np.array([[1,2,3,4,5,6,7],[10,2,-30,6,15,39,92]])
+    A,E = rpca(EEG)
+    A_win,E_win = rpca_windowed(EEG,window=10,overlap=2)
+    assert(np.array_equal(A,A_win))
+    assert(np.array_equal(E,E_win))
+    print('test_windowed_single_window Pass')
+
+def test_windowed_blending():
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(30,2),np.random.randn(2,1050))
+    sparse = np.random.randn(30,1050)*(np.random.rand(30,1050) < 0.05)*10
+    EEG = low_rank + sparse
+    A,E = rpca_windowed(EEG,window=300,overlap=50)
+    # every window satisfies M = L + S, and so does their cross-fade
+    assert(np.allclose(A+E,EEG,atol=1e-4))
+    assert(np.linalg.norm(A-low_rank)/np.linalg.norm(low_rank) < 0.1)
+    # the pool only changes where windows are solved
+    A_pool,E_pool = rpca_windowed(EEG,window=300,overlap=50,n_jobs=2)
+    assert(np.array_equal(A,A_pool))
+    assert(np.array_equal(E,E_pool))
+    print('test_windowed_blending Pass')
+
+def test_windowed_incorrect_overlap():
+    with pytest.raises(ValueError):
+        A,E = rpca_windowed(np.ones((2,20)),window=5,overlap=5)
+    print('test_windowed_incorrect_overlap Pass')
+
+def test_return_state():
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(30,2),np.random.randn(2,600))
+    sparse = np.random.randn(30,600)*(np.random.rand(30,600) < 0.05)*10
+    EEG = low_rank + sparse
+    A,E = rpca(EEG)
+    A_st,E_st,state = rpca(EEG,return_state=True)
+    assert(np.array_equal(A,A_st))
+    assert(np.array_equal(E,E_st))
+    assert(state['basis'].shape == (30,state['rank']))
+    assert(not state['warm_start'])
+    # continuing the solve on the same data converges right away
+    A_res,E_res,res_state = rpca(EEG,state=state,return_state=True)
+    assert(res_state['warm_start'])
+    assert(res_state['n_iter'] <= 2 < state['n_iter'])
+    assert(np.allclose(A,A_res,atol=1e-4))
+    print('test_return_state Pass')
+
+def test_state_new_data():
+    np.random.seed(0)
+    mixing = np.random.randn(30,2)
+    EEG1 = np.dot(mixing,np.random.randn(2,600))
+    EEG2 = np.dot(mixing,np.random.randn(2,600))
+    EEG2 = EEG2 + np.random.randn(30,600)*(np.random.rand(30,600) < 0.05)*10
+    A,E = rpca(EEG2)
+    _,_,state = rpca(EEG1,return_state=True)
+    # on other data only the rank is carried over, which the full SVD does
+    # not use
+    A_new,E_new,new_state = rpca(EEG2,state=state,return_state=True)
+    assert(new_state['warm_start'])
+    assert(np.array_equal(A,A_new))
+    assert(np.array_equal(E,E_new))
+    print('test_state_new_data Pass')
+
+def test_bounded_allocation():
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(16,2),np.random.randn(2,20000))
+    sparse = np.random.randn(16,20000)*(np.random.rand(16,20000) < 0.05)*10
+    EEG = low_rank + sparse
+    peaks = []
+    for maxIter in (2,20):
+        tracemalloc.start()
+        A,E = rpca(EEG,tol=0,maxIter=maxIter,svd_method='gram')
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    # L, S, Y and two work buffers, plus the rank x samples U^T X of the
+    # Gram path, no matter how many iterations are run
+    assert(peaks[1] < 6*EEG.nbytes)
+    assert(peaks[1]-peaks[0] < EEG.nbytes)
+    print('test_bounded_allocation Pass')
+
+def test_soft_thres_out():
+    x = np.array([-3.,-0.5,0.,0.5,3.])
+    out = np.empty(5)
+    res = soft_thres(x,1,out=out)
+    assert(res is out)
+    assert(np.array_equal(out,[-2.,0.,0.,0.,2.]))
+    print('test_soft_thres_out Pass')
+
+def test_diagnostics():
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(30,2),np.random.randn(2,600))
+    sparse = np.random.randn(30,600)*(np.random.rand(30,600) < 0.05)*10
+    EEG = low_rank + sparse
+    diagnostics = RPCADiagnostics()
+    A,E = rpca(EEG,diagnostics=diagnostics)
+    summary = diagnostics.summary()
+    assert(summary['stop_reason'] == 'converged')
+    assert(summary['n_iter'] == len(diagnostics.rank) == len(diagnostics.elapsed))
+    assert(summary['error'] <= 1e-7)
+    assert(np.isclose(summary['sparsity'],np.mean(E == 0)))
+    assert(summary['rank'] == np.linalg.matrix_rank(A))
+    diagnostics = RPCADiagnostics()
+    A,E = rpca(EEG,maxIter=3,diagnostics=diagnostics)
+    assert(diagnostics.summary()['stop_reason'] == 'max_iter')
+    assert(len(diagnostics.error) == 3)
+    print('test_diagnostics Pass')
+
+def test_stall_stop():
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(30,2),np.random.randn(2,600))
+    sparse = np.random.randn(30,600)*(np.random.rand(30,600) < 0.05)*10
+    EEG = low_rank + sparse
+    # with tol=0 the error can never be reached, it only stops improving
+    diagnostics = RPCADiagnostics()
+    A,E = rpca(EEG,tol=0,stall_window=5,diagnostics=diagnostics)
+    assert(diagnostics.stop_reason == 'stalled')
+    assert(len(diagnostics.error) < 1000)
+    assert(len(set(diagnostics.rank[-6:])) == 1)
+    print('test_stall_stop Pass')
+
+def test_batch_matches_rpca():
+    np.random.seed(0)
+    M = np.array([np.dot(np.random.randn(16,2),np.random.randn(2,400)) +
+                  np.random.randn(16,400)*(np.random.rand(16,400) < 0.05)*10
+                  for k in range(5)])
+    for svd_method in ['svd','gram']:
+        diagnostics = []
+        A,E = rpca_batch(M,svd_method=svd_method,diagnostics=diagnostics)
+        assert(A.shape == E.shape == M.shape)
+        for k in range(5):
+            solve = RPCADiagnostics()
+            A1,E1 = rpca(M[k],svd_method=svd_method,diagnostics=solve)
+            assert(np.allclose(A[k],A1,atol=1e-8))
+            assert(np.allclose(E[k],E1,atol=1e-8))
+            # every matrix stopped at its own iteration
+            assert(len(diagnostics[k].error) == len(solve.error))
+            assert(diagnostics[k].stop_reason == 'converged')
+    diagnostics = []
+    A,E = rpca_batch(M,maxIter=3,diagnostics=diagnostics)
+    assert(all(solve.stop_reason == 'max_iter' for solve in diagnostics))
+    print('test_batch_matches_rpca Pass')
+
+def test_batch_float32():
+    np.random.seed(0)
+    M = np.array([np.dot(np.random.randn(16,2),np.random.randn(2,400)) +
+                  np.random.randn(16,400)*(np.random.rand(16,400) < 0.05)*10
+                  for k in range(3)])
+    for svd_method in ['svd','gram']:
+        A,E = rpca_batch(M,svd_method=svd_method)
+        A32,E32 = rpca_batch(M.astype(np.float32),svd_method=svd_method)
+        assert(A32.dtype == E32.dtype == np.float32)
+        assert(np.linalg.norm(A32-A) < 1e-4*np.linalg.norm(A))
+    print('test_batch_float32 Pass')
+
+def test_batch_incorrect_input():
+    with pytest.raises(ValueError):
+        rpca_batch(np.random.randn(16,400))
+    with pytest.raises(ValueError):
+        rpca_batch(np.random.randn(2,16,400),svd_method='randomized')
+    print('test_batch_incorrect_input Pass')
+
+def test_coreset():
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(30,2),np.random.randn(2,3000))
+    sparse = np.random.randn(30,3000)*(np.random.rand(30,3000) < 0.05)*10
+    EEG = low_rank + sparse
+    A,E = rpca(EEG)
+    for coreset_sampling in ['uniform','leverage']:
+        for coreset in [0.1,300]:
+            A1,E1 = rpca(EEG,coreset=coreset,coreset_sampling=coreset_sampling)
+            assert(A1.shape == E1.shape == EEG.shape)
+            assert(np.linalg.norm(A1-A)/np.linalg.norm(A) < 0.05)
+            assert(np.linalg.norm(A1-low_rank)/np.linalg.norm(low_rank) < 0.05)
+    A32,E32 = rpca(EEG.astype(np.float32),coreset=0.1)
+    assert(A32.dtype == E32.dtype == np.float32)
+    assert(np.linalg.norm(A32-A)/np.linalg.norm(A) < 0.05)
+    # the state and diagnostics come from the solve of the sample
+    diagnostics = RPCADiagnostics()
+    A1,E1,state = rpca(EEG,coreset=300,return_state=True,diagnostics=diagnostics)
+    assert(state['n_iter'] == len(diagnostics.error))
+    with pytest.raises(ValueError):
+        rpca(EEG,coreset=0.1,coreset_sampling='random')
+    print('test_coreset Pass')
+
+def test_column_leverage():
+    np.random.seed(0)
+    EEG = np.dot(np.random.randn(30,5),np.random.randn(5,600))
+    EEG[:,10] *= 100
+    leverage = column_leverage(EEG)
+    assert(leverage.shape == (600,))
+    assert(np.isclose(np.sum(leverage),5))
+    assert(np.argmax(leverage) == 10)
+    print('test_column_leverage Pass')
+
+def test_altproj():
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(30,2),np.random.randn(2,600))
+    sparse = np.random.randn(30,600)*(np.random.rand(30,600) < 0.05)*10
+    EEG = low_rank + sparse
+    for svd_method in ['svd','gram','randomized']:
+        diagnostics = RPCADiagnostics()
+        A,E,state = rpca_altproj(EEG,svd_method=svd_method,rank=2,
+                                 return_state=True,diagnostics=diagnostics)
+        assert(np.allclose(A,low_rank,atol=1e-6))
+        assert(diagnostics.stop_reason == 'converged')
+        assert(diagnostics.rank[0] == 1 and diagnostics.rank[-1] == 2)
+        assert(state['rank'] == 2 and state['n_iter'] == len(diagnostics.error))
+    # warm started from its rank, the stage of rank 1 is skipped
+    diagnostics = RPCADiagnostics()
+    A,E = rpca_altproj(EEG,rank=2,state=state,diagnostics=diagnostics)
+    assert(set(diagnostics.rank) == {2})
+    diagnostics = RPCADiagnostics()
+    A,E = rpca_altproj(EEG,rank=2,maxIter=3,diagnostics=diagnostics)
+    assert(diagnostics.stop_reason == 'max_iter')
+    print('test_altproj Pass')
+
+def test_solver_registry():
+    assert(get_solver('alm') is rpca)
+    assert(get_solver('altproj') is rpca_altproj)
+    with pytest.raises(ValueError):
+        get_solver('admm')
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(30,2),np.random.randn(2,1050))
+    sparse = np.random.randn(30,1050)*(np.random.rand(30,1050) < 0.05)*10
+    A,E = rpca_windowed(low_rank + sparse,300,50,solver='altproj',rank=2)
+    assert(np.allclose(A,low_rank,atol=1e-4))
+    with pytest.raises(ValueError):
+        rpca_windowed(low_rank,300,50,solver='admm')
+    print('test_solver_registry Pass')
+
+def test_hard_thres():
+    x = np.array([-3.,-0.5,0.,0.5,3.])
+    out = np.empty(5)
+    res = hard_thres(x,1,out=out)
+    assert(res is out)
+    assert(np.array_equal(out,[-3.,0.,0.,0.,3.]))
+    print('test_hard_thres Pass')
+
+class Preempted(Exception):
+    pass
+
+class PreemptAt(RPCADiagnostics):
+    # raises in the middle of a solve, like a job killed by the scheduler
+    def __init__(self, n_iter):
+        super().__init__()
+        self.n_iter = n_iter
+
+    def record(self, *args):
+        super().record(*args)
+        if len(self.error) == self.n_iter:
+            raise Preempted
+
+def test_checkpoint_resume(tmp_path):
+    np.random.seed(0)
+    low_rank = np.dot(np.random.randn(30,2),np.random.randn(2,600))
+    sparse = np.random.randn(30,600)*(np.random.rand(30,600) < 0.05)*10
+    EEG = low_rank + sparse
+    checkpoint = str(tmp_path / 'rpca')
+    for svd_method in ['gram','randomized']:
+        A,E = rpca(EEG,svd_method=svd_method)
+        with pytest.raises(Preempted):
+            rpca(EEG,svd_method=svd_method,checkpoint=checkpoint,
+                 checkpoint_interval=0,diagnostics=PreemptAt(10))
+        assert((tmp_path / 'rpca.json').exists())
+        # a checkpoint of other data is ignored, and kept
+        diagnostics = RPCADiagnostics()
+        rpca(EEG[:,:300],maxIter=1,diagnostics=diagnostics,checkpoint=checkpoint)
+        assert(len(diagnostics.error) == 1)
+        assert((tmp_path / 'rpca.json').exists())
+        diagnostics = RPCADiagnostics()
+        A2,E2 = rpca(EEG,svd_method=svd_method,checkpoint=checkpoint,
+                     diagnostics=diagnostics)
+        # resumed after the 9th iteration and ended where the full solve did
+        assert(len(diagnostics.error) < 30)
+        assert(np.array_equal(A,A2))
+        assert(np.array_equal(E,E2))
+        assert(list(tmp_path.iterdir()) == [])
+    print('test_checkpoint_resume Pass')
@@ -2,8 +2,15 @@ import matplotlib.pyplot as plt
 import mne
 import numpy as np
 import pytest
+from scipy import sparse
 
-from pyautomagic.preprocessing.preprocess import Preprocess
+from pyautomagic.preprocessing.cache import StageCache
+from pyautomagic.preprocessing.perform_EOG_regression import perform_EOG_regression
+from pyautomagic.preprocessing.preprocess import (Preprocess, invalidated_stages,
+                                                  perform_RPCA_batch,
+                                                  stage_order, stage_params)
+from pyautomagic.src.calcQuality import calcQuality
+from pyautomagic.src.rateQuality import rateQuality
 
 
 #Test each output type on a sample data set
@@ -58,3 +65,378 @@ def test_sample_input2_correctType():
     assert(type(eeg) == mne.io.edf.edf.RawEDF)
     assert(type(fig1) == type(plt.figure()))
     assert(type(fig2) == type(plt.figure()))
+
+
+#Test that the sparse noise holds the same values as the dense one
+def test_sparse_noise():
+    raw = mne.io.read_raw_edf('./tests/test_data/S001R01.edf')
+    raw.rename_channels(lambda s: s.strip("."))
+    raw.rename_channels(lambda s: s.replace("c", "C").replace("o", "O").\
+      replace("f", "F").replace("t", "T").replace("Tp", "TP").replace("Cp", "CP"))
+    params = {'line_freqs' : 50,\
+              'filter_type' : 'high', \
+              'filt_freq' : None, \
+              'filter_length' : 'auto', \
+              'eog_regression' : False, \
+              'lam' : -1, \
+              'tol' : 1e-7, \
+              'max_iter': 1000, \
+              'interpolation_params': {'line_freqs' : raw.info['sfreq'],\
+                                       'ref_chs': raw.ch_names,\
+                                       'reref_chs': raw.ch_names,\
+                                       'montage': 'standard_1020'}
+              }
+    preprocess = Preprocess(raw.copy(), params)
+    eeg,fig1,fig2 = preprocess.fit()
+    dense = preprocess.noise
+    params['sparse_noise'] = True
+    preprocess = Preprocess(raw.copy(), params)
+    eeg,fig1,fig2 = preprocess.fit()
+    assert(sparse.issparse(preprocess.noise))
+    assert(preprocess.noise.nnz < dense.size)
+    assert(np.array_equal(preprocess.noise.toarray(),dense))
+
+
+#Test that batched RPCA gives the same result as one solve per recording
+def test_perform_RPCA_batch():
+    raw = mne.io.read_raw_edf('./tests/test_data/S001R01.edf')
+    raw.rename_channels(lambda s: s.strip("."))
+    raw.rename_channels(lambda s: s.replace("c", "C").replace("o", "O").\
+      replace("f", "F").replace("t", "T").replace("Tp", "TP").replace("Cp", "CP"))
+    params = {'line_freqs' : 50,\
+              'filter_type' : 'high', \
+              'filt_freq' : None, \
+              'filter_length' : 'auto', \
+              'eog_regression' : False, \
+              'lam' : -1, \
+              'tol' : 1e-7, \
+              'max_iter': 1000, \
+              'interpolation_params': {'line_freqs' : raw.info['sfreq'],\
+                                       'ref_chs': raw.ch_names,\
+                                       'reref_chs': raw.ch_names,\
+                                       'montage': 'standard_1020'}
+              }
+    runs = [raw.copy().crop(0,20), raw.copy().crop(20,40)]
+    preprocesses = [Preprocess(run, params) for run in runs]
+    for preprocess in preprocesses:
+        preprocess.prepare_RPCA()
+    perform_RPCA_batch(preprocesses)
+    for run, batched in zip(runs, preprocesses):
+        assert(batched.automagic['perform_RPCA']['stop_reason'] == ['converged'])
+        eeg,fig1,fig2 = batched.fit()
+        preprocess = Preprocess(run.copy(), params)
+        eeg_single,fig1,fig2 = preprocess.fit()
+        assert(np.allclose(eeg.get_data(), eeg_single.get_data()))
+    preprocesses = [Preprocess(raw.copy().crop(0,10), params),
+                    Preprocess(raw.copy().crop(0,20), params)]
+    for preprocess in preprocesses:
+        preprocess.prepare_RPCA()
+    with pytest.raises(ValueError):
+        perform_RPCA_batch(preprocesses)
+    # options rpca_batch does not implement are solved one by one
+    params = dict(params, rpca_solver='altproj', rpca_solver_params={'rank': 5})
+    preprocesses = [Preprocess(run.copy().crop(0,10), params) for run in runs]
+    for preprocess in preprocesses:
+        preprocess.prepare_RPCA()
+    perform_RPCA_batch(preprocesses)
+    for run, batched in zip(runs, preprocesses):
+        assert('perform_RPCA' in batched.performed)
+        preprocess = Preprocess(run.copy().crop(0,10), params)
+        eeg_single,fig1,fig2 = preprocess.fit()
+        assert(np.array_equal(batched.eeg_filt_eog_rpca.get_data(),
+                              eeg_single.get_data()))
+
+
+#Test that resampling runs every step at the new rate
+def test_resample():
+    raw = mne.io.read_raw_edf('./tests/test_data/S001R01.edf')
+    raw.rename_channels(lambda s: s.strip("."))
+    raw.rename_channels(lambda s: s.replace("c", "C").replace("o", "O").\
+      replace("f", "F").replace("t", "T").replace("Tp", "TP").replace("Cp", "CP"))
+    params = {'line_freqs' : 50,\
+              'filter_type' : 'high', \
+              'filt_freq' : None, \
+              'filter_length' : 'auto', \
+              'eog_regression' : False, \
+              'lam' : -1, \
+              'tol' : 1e-7, \
+              'max_iter': 1000, \
+              'resample_sfreq': raw.info['sfreq'] / 2, \
+              'interpolation_params': {'line_freqs' : raw.info['sfreq'],\
+                                       'ref_chs': raw.ch_names,\
+                                       'reref_chs': raw.ch_names,\
+                                       'montage': 'standard_1020'}
+              }
+    n_times = raw.n_times
+    preprocess = Preprocess(raw, params)
+    eeg,fig1,fig2 = preprocess.fit()
+    assert(eeg.info['sfreq'] == params['resample_sfreq'])
+    assert(eeg.get_data().shape == (len(raw.ch_names), n_times // 2))
+    assert(preprocess.eeg.info['sfreq'] == params['resample_sfreq'])
+    assert(eeg.ch_names == raw.ch_names)
+
+
+#Test that the float32 pipeline filters, regresses out EOG, solves RPCA (also
+#batched) and rates as the float64 one
+@pytest.mark.parametrize('fname', ['S001R01.edf', 'S002R01.edf'])
+def test_float32(fname):
+    raw = mne.io.read_raw_edf('./tests/test_data/' + fname)
+    raw.rename_channels(lambda s: s.strip("."))
+    raw.rename_channels(lambda s: s.replace("c", "C").replace("o", "O").\
+      replace("f", "F").replace("t", "T").replace("Tp", "TP").replace("Cp", "CP"))
+    raw.set_channel_types({'Fp1': 'eog'})
+    params = {'line_freqs' : 50,\
+              'filter_type' : 'high', \
+              'filt_freq' : None, \
+              'filter_length' : 'auto', \
+              'eog_regression' : True, \
+              'lam' : -1, \
+              'tol' : 1e-7, \
+              'max_iter': 1000, \
+              'interpolation_params': {'line_freqs' : raw.info['sfreq'],\
+                                       'ref_chs': raw.ch_names,\
+                                       'reref_chs': raw.ch_names,\
+                                       'montage': 'standard_1020'}
+              }
+    results = []
+    for dtype in ['float64', 'float32']:
+        params['dtype'] = dtype
+        preprocess = Preprocess(raw.copy(), params)
+        preprocess.prepare_RPCA()
+        preprocess.perform_RPCA()
+        eeg = preprocess.eeg_filt_eog_rpca
+        assert(preprocess.automagic['perform_eog_regression'])
+        assert(preprocess.automagic['perform_RPCA']['stop_reason'] == ['converged'])
+        stages = [preprocess.filtered, preprocess.eeg_filt_eog, eeg]
+        assert(all(stage._data.dtype == dtype for stage in stages))
+        # quality thresholds are in microvolts
+        quality = calcQuality(eeg.get_data() * 1e6,
+                              preprocess.automagic['auto_bad_chans'])
+        results.append(([stage.get_data() for stage in stages], quality,
+                        rateQuality(quality)))
+    (stages64, quality64, rate64), (stages32, quality32, rate32) = results
+    for data32, data64 in zip(stages32, stages64):
+        assert(np.linalg.norm(data32 - data64) < 1e-4 * np.linalg.norm(data64))
+    assert(rate32 == rate64)
+    for key in quality64:
+        assert(np.isclose(quality32[key], quality64[key], rtol=1e-3))
+    batched = [Preprocess(raw.copy(), params) for _ in range(2)]
+    for preprocess in batched:
+        preprocess.prepare_RPCA()
+    perform_RPCA_batch(batched)
+    for preprocess in batched:
+        data32 = preprocess.eeg_filt_eog_rpca._data
+        assert(data32.dtype == np.float32)
+        assert(preprocess.noise.dtype == np.float32)
+        assert(np.linalg.norm(data32 - stages64[2]) <
+               1e-4 * np.linalg.norm(stages64[2]))
+
+
+#Test that the EOG regression coefficients of a first run are reused
+def test_eog_coef_file(tmp_path):
+    np.random.seed(0)
+    info = mne.create_info(['Fz', 'Cz', 'Pz', 'Oz', 'EOG'], 100.,
+                           ['eeg'] * 4 + ['eog'])
+    params = {'eog_regression' : True}
+    fname = str(tmp_path / 'eog_coefficients.npz')
+    runs = []
+    for run in range(2):
+        eog = np.random.randn(1, 2000)
+        eeg = np.random.randn(4, 2000) + np.dot([[1.], [.5], [.2], [.1]], eog)
+        runs.append(mne.io.RawArray(np.concatenate([eeg, eog]), info))
+    preprocess = Preprocess(runs[0].copy(), params, eog_coef_file=fname)
+    eeg_filt_eog = preprocess.perform_eog_regression()
+    assert(preprocess.automagic['eog_coefficients'] == 'fitted')
+    data = runs[0].get_data()
+    assert(np.allclose(eeg_filt_eog.get_data()[:4],
+                       perform_EOG_regression(data[:4], data[4])))
+    assert(np.array_equal(eeg_filt_eog.get_data()[4], data[4]))
+    coef = np.load(fname)['coef']
+    # the next run of the subject applies the coefficients of the first one
+    preprocess = Preprocess(runs[1].copy(), params, eog_coef_file=fname)
+    eeg_filt_eog = preprocess.perform_eog_regression()
+    assert(preprocess.automagic['eog_coefficients'] == 'cached')
+    data = runs[1].get_data()
+    assert(np.allclose(eeg_filt_eog.get_data()[:4],
+                       data[:4] - np.dot(coef.T, data[4:])))
+    # other channels are fitted, without replacing the coefficients
+    preprocess = Preprocess(runs[1].copy().drop_channels(['Oz']), params,
+                            eog_coef_file=fname)
+    preprocess.perform_eog_regression()
+    assert(preprocess.automagic['eog_coefficients'] == 'fitted')
+    assert(np.array_equal(np.load(fname)['coef'], coef))
+    # other filtering parameters are fitted again, and replace them
+    params = dict(params, filter_type='high', filt_freq=1.)
+    preprocess = Preprocess(runs[1].copy(), params, eog_coef_file=fname)
+    preprocess.perform_eog_regression()
+    assert(preprocess.automagic['eog_coefficients'] == 'fitted')
+    assert(not np.array_equal(np.load(fname)['coef'], coef))
+    preprocess = Preprocess(runs[0].copy(), params, eog_coef_file=fname)
+    preprocess.perform_eog_regression()
+    assert(preprocess.automagic['eog_coefficients'] == 'cached')
+
+
+#Test that the low memory mode cleans the data in place, with the same result
+def test_low_memory():
+    raw = mne.io.read_raw_edf('./tests/test_data/S001R01.edf')
+    raw.rename_channels(lambda s: s.strip("."))
+    raw.rename_channels(lambda s: s.replace("c", "C").replace("o", "O").\
+      replace("f", "F").replace("t", "T").replace("Tp", "TP").replace("Cp", "CP"))
+    params = {'line_freqs' : 50,\
+              'filter_type' : 'high', \
+              'filt_freq' : None, \
+              'filter_length' : 'auto', \
+              'eog_regression' : False, \
+              'lam' : -1, \
+              'tol' : 1e-7, \
+              'max_iter': 1000, \
+              'report_memory': True, \
+              'interpolation_params': {'line_freqs' : raw.info['sfreq'],\
+                                       'ref_chs': raw.ch_names,\
+                                       'reref_chs': raw.ch_names,\
+                                       'montage': 'standard_1020'}
+              }
+    raw = raw.crop(0,20).load_data()
+    preprocess = Preprocess(raw.copy(), params)
+    eeg,fig1,fig2 = preprocess.fit()
+    peaks = preprocess.automagic['peak_memory']
+    assert(set(peaks) == {'prep', 'filtering', 'perform_eog_regression',
+                          'perform_RPCA'})
+    params['low_memory'] = True
+    working = raw.copy()
+    preprocess = Preprocess(working, params)
+    eeg_low,fig1,fig2 = preprocess.fit()
+    assert(eeg_low is working)
+    assert(preprocess.filtered is working and preprocess.eeg_filt_eog is working)
+    assert(np.array_equal(eeg_low.get_data(), eeg.get_data()))
+    peaks_low = preprocess.automagic['peak_memory']
+    assert(peaks_low['perform_RPCA'] < peaks['perform_RPCA'])
+    assert(peaks_low['perform_eog_regression'] < peaks['perform_eog_regression'])
+
+
+#Test that a changed RPCA parameter only performs RPCA again
+def test_stage_cache(tmp_path):
+    params = {'line_freqs' : 50,\
+              'filter_type' : 'high', \
+              'filt_freq' : None, \
+              'filter_length' : 'auto', \
+              'eog_regression' : False, \
+              'lam' : -1, \
+              'tol' : 1e-7, \
+              'max_iter': 1000, \
+              'sparse_noise': True, \
+              'interpolation_params': {'line_freqs' : 160.,\
+                                       'ref_chs': [],\
+                                       'reref_chs': [],\
+                                       'montage': 'standard_1020'}
+              }
+    stage_cache = StageCache(str(tmp_path))
+    stages = ['prep', 'filtering', 'perform_RPCA']
+    results = []
+    for lam in [-1, -1, 0.05]:
+        raw = mne.io.read_raw_edf('./tests/test_data/S001R01.edf')
+        raw.rename_channels(lambda s: s.strip("."))
+        raw.rename_channels(lambda s: s.replace("c", "C").replace("o", "O").\
+          replace("f", "F").replace("t", "T").replace("Tp", "TP").replace("Cp", "CP"))
+        raw.crop(0,20)
+        params['lam'] = lam
+        params['interpolation_params']['ref_chs'] = raw.ch_names
+        params['interpolation_params']['reref_chs'] = raw.ch_names
+        preprocess = Preprocess(raw, params, stage_cache=stage_cache)
+        eeg,fig1,fig2 = preprocess.fit()
+        results.append((eeg.get_data(), preprocess))
+    (data, first), (data_again, again), (data_lam, lam) = results
+    assert([first.automagic['stage_cache'][stage] for stage in stages] ==
+           ['performed'] * 3)
+    assert([again.automagic['stage_cache'][stage] for stage in stages] ==
+           ['restored'] * 3)
+    assert([lam.automagic['stage_cache'][stage] for stage in stages] ==
+           ['restored', 'restored', 'performed'])
+    assert(np.array_equal(data_again, data))
+    assert(not np.array_equal(data_lam, data))
+    assert(np.array_equal(again.noise.toarray(), first.noise.toarray()))
+    assert(again.automagic['auto_bad_chans'] == first.automagic['auto_bad_chans'])
+    assert(again.automagic['perform_RPCA'] == first.automagic['perform_RPCA'])
+    assert(again.stage_keys == first.stage_keys)
+    assert(lam.stage_keys['filtering'] == first.stage_keys['filtering'])
+
+
+def test_stages():
+    params = {'filter_type' : 'high', \
+              'filt_freq' : None, \
+              'eog_regression' : False, \
+              'lam' : -1, \
+              'interpolation_params': {'line_freqs' : 160.}
+              }
+    assert(stage_order(params) == ['load', 'prep', 'filtering',
+                                   'perform_eog_regression', 'perform_RPCA'])
+    assert(stage_order(dict(params, resample_sfreq=80.)) ==
+           ['load', 'filtering', 'prep', 'perform_eog_regression',
+            'perform_RPCA'])
+    last = stage_params(params)
+    assert(invalidated_stages(None, params) == stage_order(params))
+    assert(invalidated_stages(last, params) == [])
+    assert(invalidated_stages(last, dict(params, lam=0.05)) == ['perform_RPCA'])
+    assert(invalidated_stages(last, dict(params, eog_regression=True)) ==
+           ['perform_eog_regression', 'perform_RPCA'])
+    assert(invalidated_stages(last, dict(params, filt_freq=1.)) ==
+           ['filtering', 'perform_eog_regression', 'perform_RPCA'])
+    # prep then depends on the resampled data
+    assert(invalidated_stages(last, dict(params, resample_sfreq=80.)) ==
+           ['filtering', 'prep', 'perform_eog_regression', 'perform_RPCA'])
+    # another recording invalidates every stage
+    last = stage_params(params, [['S001R01.edf', 100, 1]])
+    assert(invalidated_stages(last, params, [['S001R01.edf', 100, 1]]) == [])
+    assert(invalidated_stages(last, params, [['S001R01.edf', 100, 2]]) ==
+           stage_order(params))
+
+
+#Test that the stages invalidated_stages keeps are restored, not performed
+def test_partial_recompute(tmp_path, monkeypatch):
+    raw = mne.io.read_raw_edf('./tests/test_data/S001R01.edf')
+    raw.rename_channels(lambda s: s.strip("."))
+    raw.rename_channels(lambda s: s.replace("c", "C").replace("o", "O").\
+      replace("f", "F").replace("t", "T").replace("Tp", "TP").replace("Cp", "CP"))
+    raw.crop(0,20)
+    params = {'line_freqs' : 50,\
+              'filter_type' : 'high', \
+              'filt_freq' : None, \
+              'filter_length' : 'auto', \
+              'eog_regression' : False, \
+              'lam' : -1, \
+              'tol' : 1e-7, \
+              'max_iter': 1000, \
+              'interpolation_params': {'line_freqs' : raw.info['sfreq'],\
+                                       'ref_chs': raw.ch_names,\
+                                       'reref_chs': raw.ch_names,\
+                                       'montage': 'standard_1020'}
+              }
+    stage_cache = StageCache(str(tmp_path))
+    first = Preprocess(raw.copy(), params, stage_cache=stage_cache)
+    first.fit()
+    plt.close('all')
+    last = stage_params(params)
+    params = dict(params, lam=0.05)
+    assert(invalidated_stages(last, params) == ['perform_RPCA'])
+    # the bad channels of prep are saved in the results of a Block
+    stored_outputs = {'prep': ({}, {'bads': first.automagic['auto_bad_chans']})}
+
+    def performed(self):
+        raise AssertionError('stage performed')
+
+    monkeypatch.setattr(Preprocess, 'perform_prep', performed)
+    monkeypatch.setattr(Preprocess, 'perform_filter', performed)
+    again = Preprocess(raw.copy(), params, stage_cache=stage_cache,
+                       stored_outputs=stored_outputs)
+    eeg,fig1,fig2 = again.fit()
+    plt.close('all')
+    assert(again.automagic['auto_bad_chans'] == first.automagic['auto_bad_chans'])
+    assert(again.automagic['stage_cache']['filtering'] == 'restored')
+    assert(again.automagic['stage_cache']['perform_RPCA'] == 'performed')
+    # without the cache, only prep is restored
+    monkeypatch.undo()
+    monkeypatch.setattr(Preprocess, 'perform_prep', performed)
+    preprocess = Preprocess(raw.copy(), params, stored_outputs=stored_outputs)
+    eeg_single,fig1,fig2 = preprocess.fit()
+    plt.close('all')
+    assert(np.allclose(eeg_single.get_data(), eeg.get_data()))
@@ -1,7 +1,10 @@
 import pytest
+import copy
 import json
 import os
+import shutil
 from pyautomagic.src import Project
+from pyautomagic.src.Block import Block
 
 
 name = "Dummy project 123456"
@@ -105,3 +108,37 @@ def test_project_pyautomagic_run():
     os.remove(
         os.path.join(".", "tests", "test_data", "test_project", "derivatives", "automagic", "sub-18", "sub-18_task-rest_eeg_orig.png")
     )
+
+
+def test_interrupted_preprocess_all(tmp_path, monkeypatch):
+    folder = os.path.join(str(tmp_path), "test_project")
+    shutil.copytree(d_folder, folder)
+    X = Project.Project(
+        name, folder, file_ext, montage, sampling_rate, copy.deepcopy(params)
+    )
+    preprocess = Block.preprocess
+
+    def interrupted(block, *args):
+        if block.unique_name == X.block_list[1]:
+            raise KeyboardInterrupt
+        return preprocess(block, *args)
+
+    monkeypatch.setattr(Block, "preprocess", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        X.preprocess_all()
+    # the stage parameters of the finished block were saved before the
+    # interruption, so it is skipped next time
+    Y = Project.Project(
+        name, folder, file_ext, montage, sampling_rate, copy.deepcopy(params)
+    )
+    assert list(Y.stage_params) == [X.block_list[0]]
+    performed = []
+
+    def counted(block, *args):
+        performed.append(block.unique_name)
+        return {"preprocessed": True}
+
+    monkeypatch.setattr(Block, "preprocess", counted)
+    monkeypatch.setattr(Project.Project, "update_project", lambda self, results: None)
+    Y.preprocess_all()
+    assert performed == [X.block_list[1]]